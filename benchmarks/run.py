@@ -0,0 +1,335 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+"""
+Reproducible click benchmarks on the bundled forest dataset and synthetic
+worst cases. Every case runs in a fresh process, so import and cold cache
+costs are included in the same way as for a real JOSM click.
+
+    python3 benchmarks/run.py --output results.json
+    python3 benchmarks/run.py --compare benchmarks/baseline.json
+
+The comparison fails with exit code 1 if any case is slower or uses more
+memory than the baseline by more than --tolerance.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import tarfile
+import platform
+import resource
+import threading
+import multiprocessing
+from functools import partial
+from optparse import OptionParser
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+dataset = os.path.join(root, 'data', '8323903.tar.gz')
+
+smoothing_methods = ('chaikin', 'average', 'savgol')
+
+# Whole dataset
+bbox = '57.804566,52.278242,58.073729,52.432571'
+
+# Points inside the dataset: forest and field clicks, small and large features
+clicks = [
+    (52.3410, 57.8839),
+    (52.3300, 57.8700),
+    (52.3500, 57.9000),
+    (52.325917, 57.85925),
+    (52.309758, 57.871932),
+]
+
+def get_args(argv=None):
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('--data-dir', dest='data_dir',
+                      default=os.path.join(root, 'benchmarks', '.data'), type='str',
+                      help="Directory to extract the dataset to")
+
+    parser.add_option('-o', '--output', dest='output',
+                      default=None, type='str',
+                      help="Save results as JSON")
+
+    parser.add_option('--compare', dest='compare',
+                      default=None, type='str',
+                      help="Baseline JSON to compare results with")
+
+    parser.add_option('--tolerance', dest='tolerance',
+                      default=1.5, type='float',
+                      help="Allowed ratio to the baseline before a case is reported as a regression")
+
+    parser.add_option('--slack', dest='slack',
+                      default=0.05, type='float',
+                      help="Absolute time in seconds ignored when comparing, to tolerate noise of short stages")
+
+    parser.add_option('--repeat', dest='repeat',
+                      default=3, type='int',
+                      help="Number of warm clicks after the first one in every case")
+
+    parser.add_option('-k', '--filter', dest='filter',
+                      default='', type='str',
+                      help="Run only cases containing this string")
+
+    (options, args) = parser.parse_args(argv)
+    return options
+
+"""
+Extract the dataset once, later runs reuse it
+"""
+def prepare_dataset(data_dir):
+    tiles = os.path.join(data_dir, '8323903')
+    if not os.path.exists(tiles):
+        os.makedirs(data_dir, exist_ok=True)
+        with tarfile.open(dataset) as tar:
+            tar.extractall(data_dir)
+    return tiles
+
+"""
+Convert the dataset to a mosaic once, later runs reuse it
+"""
+def prepare_mosaic(data_dir, tiles):
+    mosaic = os.path.join(data_dir, '8323903.mosaic')
+    if not os.path.exists(mosaic):
+        # Convert in another process, peak RSS of the parent is inherited by the cases
+        argv = ['convert', '--bbox', bbox, '--source', os.path.join(tiles, '{zoom}', '{x}', '{y}.png'), '--output', mosaic]
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(1) as pool:
+            pool.apply(run_command, (argv,))
+    return mosaic
+
+def run_command(argv):
+    import lakkavokka
+    lakkavokka.main(argv)
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+"""
+Local stand-in for a TMS server, like `python3 -m http.server` in README
+"""
+def start_http_server(directory):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_cases(tiles, mosaic, http_port):
+    cases = []
+    for buffer in (1, 2, 3):
+        for i, (lat, lon) in enumerate(clicks):
+            cases.append({
+                'name': 'disk-b%d-click%d' % (buffer, i),
+                'argv': ['--buffer', str(buffer), '--lat', str(lat), '--lon', str(lon),
+                         '--source', os.path.join(tiles, '{zoom}', '{x}', '{y}.png')],
+            })
+        lat, lon = clicks[0]
+        cases.append({
+            'name': 'http-b%d-click0' % buffer,
+            'argv': ['--buffer', str(buffer), '--lat', str(lat), '--lon', str(lon),
+                     '--source', 'http://127.0.0.1:%d/{zoom}/{x}/{y}.png' % http_port],
+        })
+        cases.append({
+            'name': 'mosaic-b%d-click0' % buffer,
+            'argv': ['--buffer', str(buffer), '--lat', str(lat), '--lon', str(lon), '--source', mosaic],
+        })
+
+    lat, lon = clicks[0]
+    for buffer in (1, 3):
+        cases.append({
+            'name': 'synthetic-colors-b%d' % buffer,
+            'argv': ['--buffer', str(buffer), '--lat', str(lat), '--lon', str(lon)],
+            'synthetic': 'many_colors',
+        })
+    cases.append({
+        'name': 'synthetic-huge-b3',
+        'argv': ['--buffer', '3', '--lat', str(lat), '--lon', str(lon)],
+        'synthetic': 'huge_feature',
+    })
+
+    # The same long contours with faster smoothing backends, see smoothing_summary
+    for method in smoothing_methods:
+        for i in (3, 4):
+            lat, lon = clicks[i]
+            cases.append({
+                'name': 'disk-b3-click%d-%s' % (i, method),
+                'argv': ['--buffer', '3', '--lat', str(lat), '--lon', str(lon), '--smoothing', method,
+                         '--source', os.path.join(tiles, '{zoom}', '{x}', '{y}.png')],
+            })
+        lat, lon = clicks[0]
+        cases.append({
+            'name': 'synthetic-huge-b3-%s' % method,
+            'argv': ['--buffer', '3', '--lat', str(lat), '--lon', str(lon), '--smoothing', method],
+            'synthetic': 'huge_feature',
+        })
+    return cases
+
+"""
+Smoothing time and number of written nodes of every backend relative to the
+spline on the same contour
+"""
+def smoothing_summary(results):
+    lines = []
+    for name, result in sorted(results.items()):
+        for method in smoothing_methods:
+            reference = results.get(name[:-len(method) - 1])
+            if not name.endswith('-' + method) or reference is None:
+                continue
+            lines.append('%-32s smoothing %.4fs (spline %.3fs), %d nodes (spline %d)' % (
+                name, result['stages']['smoothing'], reference['stages']['smoothing'],
+                result['nodes'], reference['nodes']))
+    return lines
+
+"""
+Stages timed in the loader threads, they overlap with the tiles stage
+"""
+thread_stages = ('fetch', 'decode')
+
+"""
+Import the modules a click loads on first use. They are counted as imports,
+otherwise the cold click and the stage that happens to load them get slower
+whenever an import is made lazy.
+"""
+def warm_imports(args):
+    import PIL.Image
+    import lakkavokka.contours
+    if args.smoothing == 'spline':
+        import scipy.interpolate
+
+def run_case(case, repeat):
+    start = time.perf_counter()
+    import lakkavokka
+    from lakkavokka.writer import OsmWriter
+    from lakkavokka.instrument import profile
+    args = lakkavokka.get_args(case['argv'])
+    warm_imports(args)
+    imports = time.perf_counter() - start
+
+    if 'synthetic' in case:
+        import synthetic
+        tx, ty, _, _ = lakkavokka.locate_click(args.lat, args.lon, args.zoom, args.buffer)
+        if case['synthetic'] == 'many_colors':
+            loadFunc = synthetic.many_colors()
+        else:
+            loadFunc = synthetic.huge_feature(tx, (2**args.zoom - 1) - ty)
+    else:
+        loadFunc = lakkavokka.make_loader(args)
+
+    def click():
+        out = io.StringIO()
+        profile.reset()
+        start = time.perf_counter()
+        with OsmWriter(out) as writer:
+            lakkavokka.digitize(args, args.lat, args.lon, loadFunc, writer)
+        return time.perf_counter() - start, out.getvalue()
+
+    cold, osm = click()
+    report = profile.report()
+    warm = min(click()[0] for _ in range(repeat)) if repeat else None
+
+    stages = {name: timer['seconds'] for name, timer in report['timers'].items()}
+    stages['other'] = cold - sum(seconds for name, seconds in stages.items() if name not in thread_stages)
+    return {
+        'imports': imports,
+        'cold': cold,
+        'warm': warm,
+        'stages': stages,
+        'counters': report['counters'],
+        'nodes': osm.count('<node'),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+"""
+Run the case in a fresh interpreter to measure cold start and its own peak RSS
+"""
+def run_isolated(case, repeat):
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(run_case, (case, repeat))
+
+def compare(results, baseline, tolerance, slack):
+    regressions = []
+    for name, result in results['cases'].items():
+        if name not in baseline['cases']:
+            continue
+        expected = baseline['cases'][name]
+        for key in ('imports', 'cold', 'warm'):
+            if result[key] is not None and expected.get(key) is not None and \
+               result[key] > expected[key] * tolerance + slack:
+                regressions.append('%s: %s %.3fs, baseline %.3fs' % (name, key, result[key], expected[key]))
+        if result['peak_rss_mb'] > expected['peak_rss_mb'] * tolerance:
+            regressions.append('%s: peak RSS %.0f MB, baseline %.0f MB' % (name, result['peak_rss_mb'], expected['peak_rss_mb']))
+    return regressions
+
+def main(argv=None):
+    args = get_args(argv)
+
+    tiles = prepare_dataset(args.data_dir)
+    mosaic = prepare_mosaic(args.data_dir, tiles)
+    server = start_http_server(tiles)
+
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cases': {},
+    }
+
+    try:
+        for case in make_cases(tiles, mosaic, server.server_address[1]):
+            if args.filter not in case['name']:
+                continue
+            result = run_isolated(case, args.repeat)
+            results['cases'][case['name']] = result
+
+            stages = ' '.join('%s=%.3f' % kv for kv in sorted(result['stages'].items()))
+            print('%-24s cold %.3fs warm %.3fs rss %4.0f MB | %s' % (
+                case['name'], result['cold'], result['warm'] or 0, result['peak_rss_mb'], stages))
+    finally:
+        server.shutdown()
+
+    for line in smoothing_summary(results['cases']):
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.slack)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.exit(main())
@@ -0,0 +1,69 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+"""
+Synthetic tile sources for worst case benchmarks. Tiles are rendered from
+global pixel coordinates, so neighbouring tiles match at the edges and
+every tile can be generated independently.
+"""
+
+import numpy as np
+
+tile_size = 256
+
+def tile_grid(x, y):
+    rows, cols = np.mgrid[0:tile_size, 0:tile_size]
+    return cols + x * tile_size, rows + y * tile_size
+
+"""
+Square cells of random colors. With small cells a patch contains thousands
+of colors, which is the worst case for labeling.
+"""
+def many_colors(cell=4, seed=1):
+    def load(zoom, x, y):
+        gx, gy = tile_grid(x, y)
+        cells = (gx // cell).astype(np.uint64) * 1000003 + (gy // cell).astype(np.uint64)
+        colors = (cells * 2654435761 + seed) % (1 << 24)
+
+        rgb = np.empty((tile_size, tile_size, 3), dtype=np.uint8)
+        rgb[:, :, 0] = colors >> 16
+        rgb[:, :, 1] = (colors >> 8) & 0xFF
+        rgb[:, :, 2] = colors & 0xFF
+        return rgb
+    return load
+
+"""
+A single blob with a wavy outline centered at the given tile. With a radius
+of a few tiles it produces contours with tens of thousands of vertices.
+"""
+def huge_feature(center_x, center_y, radius=700, waves=40, amplitude=25):
+    cx, cy = (center_x + 0.5) * tile_size, (center_y + 0.5) * tile_size
+
+    def load(zoom, x, y):
+        gx, gy = tile_grid(x, y)
+        dx, dy = gx - cx, gy - cy
+        outline = radius + amplitude * np.sin(waves * np.arctan2(dy, dx))
+
+        rgb = np.zeros((tile_size, tile_size, 3), dtype=np.uint8)
+        rgb[np.hypot(dx, dy) < outline] = (0, 100, 0)
+        return rgb
+    return load
@@ -19,19 +19,95 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 ################################################################################
+import os
+import sys
+import importlib
+from contextlib import contextmanager
 from optparse import OptionParser
 
-from lakkavokka.contours import find_single_contour, prepare_tags
-from lakkavokka.global_mercator import GlobalMercator
-from lakkavokka.load import loadFromDisk, downloadTile
+from lakkavokka.writer import writers
+from lakkavokka.instrument import profiled
 
-def get_args():
-    usage = "usage: %prog [options] --lat <latitude> --lon <longitude>"
-    parser = OptionParser(usage=usage)
+tile_size = 256
 
-    parser.add_option('-b', '--buffer', dest='buffer',
-                      default=1, type='int',
-                      help='Buffer size arout the click point in tile. --b 1 means that 3x3 tile block will be analyzed')
+"""
+OpenCV, NumPy, Shapely, SciPy, PIL and requests take much longer to import
+than a click takes to process, so they are imported only on the code paths
+using them and `--help` or a usage error doesn't load any of them. Names
+of the modules below are still available from the package and are resolved
+on first access.
+"""
+lazy_names = {
+    'find_single_contour': 'lakkavokka.contours',
+    'prepare_tags': 'lakkavokka.contours',
+    'parse_color': 'lakkavokka.contours',
+    'GlobalMercator': 'lakkavokka.global_mercator',
+    'loadFromDisk': 'lakkavokka.load',
+    'downloadTile': 'lakkavokka.load',
+    'get_session': 'lakkavokka.load',
+    'openArchive': 'lakkavokka.load',
+    'MosaicSource': 'lakkavokka.mosaic',
+    'tile_cache': 'lakkavokka.cache',
+    'TileStore': 'lakkavokka.cache',
+}
+
+def __getattr__(name):
+    if name in lazy_names:
+        return getattr(importlib.import_module(lazy_names[name]), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+"""
+Smoothing methods. Keep in sync with lakkavokka.smoothing.backends
+"""
+smoothing_methods = ['spline', 'chaikin', 'average', 'savgol', 'none']
+
+commands = {
+    'serve': 'lakkavokka.server',
+    'batch': 'lakkavokka.batch',
+    'bulk': 'lakkavokka.bulk',
+    'convert': 'lakkavokka.convert',
+    'prefetch': 'lakkavokka.prefetch',
+    'index': 'lakkavokka.index',
+}
+
+"""
+Options of the tile source and its downloads and of profiling, shared by all
+commands loading tiles
+"""
+def add_source_options(parser):
+    parser.add_option('--source', dest='source',
+                      default='http://localhost:9000/{zoom}/{x}/{y}.png', type='str',
+                      help="TMS tiles source. Can be either an URL of a path. See README about variable substitution")
+
+    parser.add_option('--concurrency', dest='concurrency',
+                      default=8, type='int',
+                      help="Number of tiles loaded in parallel")
+
+    parser.add_option('--timeout', dest='timeout',
+                      default=10, type='float',
+                      help="Tile download timeout in seconds")
+
+    parser.add_option('--retries', dest='retries',
+                      default=3, type='int',
+                      help="Number of retries for failed tile downloads")
+
+    parser.add_option('--backoff', dest='backoff',
+                      default=0.5, type='float',
+                      help="Backoff factor in seconds between download retries, doubled on every retry")
+
+    parser.add_option('--profile', dest='profile',
+                      default=None, type='str', metavar='FILE',
+                      help="Write time and amount of data of every processing stage as JSON to FILE, '-' for standard error")
+
+    parser.add_option('--cprofile', dest='cprofile',
+                      default=None, type='str', metavar='FILE',
+                      help="Dump cProfile statistics of the run to FILE, see the pstats module")
+
+"""
+Parser with options shared by all commands producing ways
+"""
+def make_parser(usage):
+    parser = OptionParser(usage=usage)
 
     parser.add_option('-z', '--zoom', dest='zoom',
                       default=16, type='int',
@@ -45,9 +121,87 @@ def get_args():
                       default='', type='str',
                       help="Comma-separated list of tags for the new objects")
 
-    parser.add_option('--source', dest='source',
-                      default='http://localhost:9000/{zoom}/{x}/{y}.png', type='str',
-                      help="TMS tiles source. Can be either an URL of a path. See README about variable substitution")
+    add_source_options(parser)
+
+    parser.add_option('--cache-dir', dest='cache_dir',
+                      default=None, type='str',
+                      help="Directory to keep downloaded tiles in. Stored tiles are revalidated with ETag/Last-Modified")
+
+    parser.add_option('--cache-size', dest='cache_size',
+                      default=256, type='int',
+                      help="Size of the in-memory cache of decoded tiles in megabytes, 0 disables it")
+
+    parser.add_option('-f', '--format', dest='format',
+                      default='osm', type='choice', choices=list(writers),
+                      help="Output format: osm (default) or geojson")
+
+    parser.add_option('-o', '--output', dest='output',
+                      default='-', type='str',
+                      help="Output file, standard output by default")
+
+    return parser
+
+"""
+Options of commands digitizing ways around clicked points
+"""
+def add_click_options(parser):
+    parser.add_option('-b', '--buffer', dest='buffer',
+                      default=1, type='int',
+                      help='Buffer size arout the click point in tile. --b 1 means that 3x3 tile block will be analyzed')
+
+    parser.add_option('--seed', dest='seed',
+                      default=False, action='store_true',
+                      help="Trace only the region connected to the clicked point instead of the whole patch")
+
+    parser.add_option('--adaptive', dest='max_tiles',
+                      default=0, type='int', metavar='MAX_TILES',
+                      help="Ignore --buffer and start with the clicked tile, adding tiles only where the clicked region touches the patch edge, up to MAX_TILES tiles")
+
+    parser.add_option('--smoothing', dest='smoothing',
+                      default=None, type='choice', choices=smoothing_methods,
+                      help="Contour smoothing: spline (default, savgol with --coarse-zoom or --index), chaikin, average, savgol or none")
+
+    parser.add_option('--coarse-zoom', dest='coarse_zoom',
+                      default=0, type='int', metavar='ZOOM',
+                      help="Find the clicked region at ZOOM first, within --buffer or --adaptive tiles of ZOOM, and load only the tiles of --zoom along its outline. Implies --seed")
+
+    parser.add_option('--background', dest='background',
+                      default='0', type='str', metavar='COLOR',
+                      help="Color of missing tiles: '#rrggbb' for RGB tiles or a palette index, 0 by default")
+
+    parser.add_option('--patch-cache-size', dest='patch_cache_size',
+                      default=64, type='int',
+                      help="Size of the in-memory cache of traced patches in megabytes, 0 disables it. Clicks in an already traced patch skip loading and tracing")
+
+    parser.add_option('--index', dest='index',
+                      default=None, type='str', metavar='INDEX',
+                      help="Answer clicks from polygons indexed by `lakkavokka index`, tiles outside the index are digitized as usual")
+
+"""
+Validate the options added by add_click_options
+"""
+def check_click_options(parser, options):
+    if options.coarse_zoom and not options.zoom - 8 <= options.coarse_zoom <= options.zoom - 1:
+        parser.error('--coarse-zoom must be from %d to %d for --zoom %d' % (options.zoom - 8, options.zoom - 1, options.zoom))
+
+    # Outlines of --coarse-zoom regions are long, the spline takes minutes on them
+    if options.coarse_zoom and options.smoothing == 'spline':
+        parser.error('--smoothing spline is too slow with --coarse-zoom, use savgol, average, chaikin or none')
+    # Indexes are smoothed with savgol by default, clicks answered from the
+    # raster match indexed answers only with the same smoothing
+    if options.smoothing is None:
+        options.smoothing = 'savgol' if options.coarse_zoom or options.index else 'spline'
+
+def get_args(argv=None):
+    usage = "usage: %prog [options] --lat <latitude> --lon <longitude>\n" \
+            "       %prog serve [options]\n" \
+            "       %prog batch [options] --input <points.csv|points.geojson>\n" \
+            "       %prog bulk [options] --bbox <min_lon,min_lat,max_lon,max_lat> --class <color>:<tags>\n" \
+            "       %prog convert [options] --bbox <min_lon,min_lat,max_lon,max_lat> --output <tiles.mosaic>\n" \
+            "       %prog prefetch [options] --bbox <min_lon,min_lat,max_lon,max_lat> --output <directory>\n" \
+            "       %prog index [options] --bbox <min_lon,min_lat,max_lon,max_lat> --class <color>:<tags> --output <index.sqlite>"
+    parser = make_parser(usage)
+    add_click_options(parser)
 
     parser.add_option('--lat', dest='lat',
                       type='float',
@@ -57,7 +211,8 @@ def get_args():
                       type='float',
                       help="Longituse in decimal form (35.1234)")
 
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv)
+    check_click_options(parser, options)
 
     if not options.lat or not options.lon:
         parser.print_usage()
@@ -66,28 +221,142 @@ def get_args():
 
     return options
 
-def main(argv=None):
-    args = get_args()
+"""
+--source with a local path made absolute, URLs are kept as they are
+"""
+def source_path(source):
+    if source.startswith(('http://', 'https://')):
+        return source
+    scheme, separator, path = source.rpartition('://')
+    return scheme + separator + os.path.abspath(path)
 
-    zoom = args.zoom
-    offset = args.buffer
-    tile_size = 256
+"""
+Key of the --source in the tile and patch caches. `serve` runs clicks in the
+working directories of the clients, so relative paths are made absolute, and
+archives are keyed with their modification time, so a rebuilt one is read
+again.
+"""
+def source_key(source):
+    source = source_path(source)
+    path = source.rpartition('://')[2]
+    if not source.startswith(('http://', 'https://')) and os.path.isfile(path):
+        return '%s@%d' % (source, os.stat(path).st_mtime_ns)
+    return source
 
+"""
+Stamp function (zoom, x, y) -> modification time of the tile file for a local
+tile tree, None for other sources. Cached tiles and patches of a tree are
+keyed with it.
+"""
+def make_stamp(source):
+    from lakkavokka.load import openArchive, diskTileStamp
 
-    tags = prepare_tags(args.tags)
+    if source.startswith(('http://', 'https://')) or openArchive(source) is not None:
+        return None
+    return lambda zoom, x, y: diskTileStamp(zoom, x, y, source)
+
+"""
+Build the tile loader for the --source option
+"""
+def make_loader(args):
+    from lakkavokka.load import openArchive, loadFromDisk, downloadTile, get_session
+    from lakkavokka.mosaic import MosaicSource
+    from lakkavokka.cache import tile_cache, TileStore
+
+    if args.source.startswith(('http://', 'https://')):
+        store = TileStore(args.cache_dir) if args.cache_dir else None
+        session = get_session(args.concurrency, args.retries, args.backoff)
+        loadFunc = lambda zoom, x, y: downloadTile(zoom, x, y, args.source, store, session, args.timeout)
+    else:
+        archive = openArchive(args.source)
+        if isinstance(archive, MosaicSource):
+            # Mosaic tiles are views of a memory mapped file, the OS caches them
+            return archive.load
+        elif archive is not None:
+            loadFunc = archive.load
+        else:
+            loadFunc = lambda zoom, x, y: loadFromDisk(zoom, x, y, args.source)
+
+    if args.cache_size <= 0:
+        return loadFunc
+
+    tile_cache.resize(args.cache_size * 1024 * 1024)
+    return tile_cache.wrap(loadFunc, source_key(args.source), make_stamp(args.source))
+
+"""
+Stream for the --output option, '-' stands for standard output. The file of
+a failed run is removed rather than left with partial output.
+"""
+@contextmanager
+def open_output(path):
+    if path == '-':
+        yield sys.stdout
+    else:
+        with open(path, 'w', encoding='utf-8') as out:
+            try:
+                yield out
+            except BaseException:
+                out.close()
+                os.unlink(path)
+                raise
+
+"""
+Tile of the clicked point and the click position inside the patch
+"""
+def locate_click(lat, lon, zoom, offset):
+    from lakkavokka.global_mercator import GlobalMercator
 
     proj = GlobalMercator()
-    mx, my = proj.LatLonToMeters(args.lat, args.lon)
+    mx, my = proj.LatLonToMeters(lat, lon)
     tx, ty = proj.MetersToTile(mx, my, zoom)
     px, py = proj.MetersToPixels(mx, my, zoom)
     click_x, click_y = int(px - tile_size * (tx - offset)), int(py - tile_size * (ty - offset))
     click_y = tile_size * (2 * offset + 1) - click_y
+    return tx, ty, click_x, click_y
 
-    if '://' in args.source:
-        loadFunc = lambda zoom, x, y: downloadTile(zoom, x, y, args.source)
-    else:
-        loadFunc = lambda zoom, x, y: loadFromDisk(zoom, x, y, args.source)
+"""
+Write the way nearest to the given point. Returns the next free id.
+"""
+def digitize(args, lat, lon, loadFunc, writer, id=-1):
+    from lakkavokka.contours import find_single_contour, prepare_tags, parse_color
+    from lakkavokka.cache import patch_cache
+
+    tags = prepare_tags(args.tags)
+    if args.index:
+        from lakkavokka.index import openIndex, find_indexed_contour
+        next_id = find_indexed_contour(openIndex(args.index), args.zoom, lat, lon, writer, loadFunc, args.source,
+                                       tags, id, args.smoothing, args.simplify_tolerance_factor)
+        if next_id is not None:
+            return next_id
+
+    tx, ty, click_x, click_y = locate_click(lat, lon, args.zoom, args.buffer)
+
+    patch_cache.resize(args.patch_cache_size * 1024 * 1024)
+    source, stamp = None, None
+    if args.patch_cache_size > 0:
+        source, stamp = source_key(args.source), make_stamp(args.source)
+
+    return find_single_contour(args.zoom, tx, ty, click_x, click_y, args.buffer, loadFunc, writer,
+                               args.simplify_tolerance_factor, tags, args.concurrency, args.seed, args.max_tiles, id,
+                               parse_color(args.background), args.coarse_zoom, args.smoothing, source, stamp)
+
+"""
+Digitize the way around the clicked point and write it to --output
+"""
+def run(args):
+    loadFunc = make_loader(args)
+
+    with profiled(args.profile, args.cprofile), \
+         open_output(args.output) as out, writers[args.format](out) as writer:
+        digitize(args, args.lat, args.lon, loadFunc, writer)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
 
-    osm = find_single_contour(zoom, tx, ty, click_x, click_y, offset, loadFunc, args.simplify_tolerance_factor, tags)
+    if argv and argv[0] in commands:
+        command = importlib.import_module(commands[argv[0]])
+        return command.main(argv[1:])
 
-    print(osm.prettify())
+    args = get_args(argv)
+    run(args)
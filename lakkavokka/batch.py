@@ -0,0 +1,206 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import os
+import sys
+import csv
+import json
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from lakkavokka import make_parser, add_click_options, check_click_options, make_loader, open_output, locate_click, digitize
+from lakkavokka.writer import writers, RecordingWriter
+from lakkavokka.instrument import profile, profiled
+
+def get_args(argv=None):
+    usage = "usage: %prog batch [options] --input <points.csv|points.geojson>"
+    parser = make_parser(usage)
+    add_click_options(parser)
+
+    parser.add_option('-i', '--input', dest='input',
+                      type='str',
+                      help="CSV file with lat and lon columns or GeoJSON file with points")
+
+    parser.add_option('-w', '--workers', dest='workers',
+                      default=os.cpu_count(), type='int',
+                      help="Number of worker processes, all CPU cores by default")
+
+    (options, args) = parser.parse_args(argv)
+    check_click_options(parser, options)
+
+    if not options.input:
+        parser.print_usage()
+        print('--input option is required')
+        exit(-1)
+
+    return options
+
+"""
+Read (lat, lon) pairs from CSV. Columns are found by the header (lat/latitude
+and lon/lng/longitude); files without a header are read as lat,lon.
+"""
+def read_csv_points(f):
+    rows = [row for row in csv.reader(f) if row]
+    if not rows:
+        return []
+
+    try:
+        float(rows[0][0]), float(rows[0][1])
+        lat_col, lon_col = 0, 1
+    except ValueError:
+        header = [name.strip().lower() for name in rows.pop(0)]
+        lat_col = next(i for i, name in enumerate(header) if name in ('lat', 'latitude'))
+        lon_col = next(i for i, name in enumerate(header) if name in ('lon', 'lng', 'long', 'longitude'))
+
+    return [(float(row[lat_col]), float(row[lon_col])) for row in rows]
+
+"""
+Read (lat, lon) pairs from Point and MultiPoint geometries of GeoJSON
+"""
+def read_geojson_points(f):
+    def points(obj):
+        if obj['type'] == 'FeatureCollection':
+            for feature in obj['features']:
+                yield from points(feature)
+        elif obj['type'] == 'Feature':
+            if obj['geometry']:
+                yield from points(obj['geometry'])
+        elif obj['type'] == 'Point':
+            yield obj['coordinates'][1], obj['coordinates'][0]
+        elif obj['type'] == 'MultiPoint':
+            for lon, lat, *_ in obj['coordinates']:
+                yield lat, lon
+
+    return list(points(json.load(f)))
+
+def read_points(path):
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.json') or path.endswith('.geojson'):
+            return read_geojson_points(f)
+        else:
+            return read_csv_points(f)
+
+"""
+Split points into tasks so points needing the same tiles are processed by
+the same worker and reuse its tile and patch caches. Points are grouped by
+their clicked tiles, tiles closer than a patch size join the same group, so
+no tile is loaded by two groups. With --coarse-zoom the tiles of the coarse
+zoom are grouped. Groups larger than an even share of the workers are cut
+into bands of rows to keep all workers busy, only tiles at the cuts are
+loaded twice.
+"""
+def group_points(points, args):
+    zoom = args.coarse_zoom or args.zoom
+    reach = 2 * args.buffer
+    tiles = {}
+    for lat, lon in points:
+        tx, ty, _, _ = locate_click(lat, lon, zoom, args.buffer)
+        tiles.setdefault((ty, tx), []).append((lat, lon))
+
+    # Union of tiles with overlapping patches
+    parent = {tile: tile for tile in tiles}
+    def find(tile):
+        while parent[tile] != tile:
+            parent[tile] = parent[parent[tile]]
+            tile = parent[tile]
+        return tile
+
+    for ty, tx in tiles:
+        for dy in range(-reach, reach + 1):
+            for dx in range(-reach, reach + 1):
+                if (ty + dy, tx + dx) in parent:
+                    parent[find((ty + dy, tx + dx))] = find((ty, tx))
+
+    components = {}
+    for tile in sorted(tiles):
+        components.setdefault(find(tile), []).extend(tiles[tile])
+
+    limit = max(1, -(-len(points) // max(1, args.workers)))
+    groups = []
+    for component in sorted(components.values(), key=len, reverse=True):
+        groups.extend(component[i:i + limit] for i in range(0, len(component), limit))
+    return groups
+
+"""
+Digitize a group of points in a worker process. Returns recorded elements
+with ids starting from -1, the number of used ids, failed points and the
+profile of the group when it was processed by a worker process.
+"""
+def process_group(task):
+    args, points = task
+    loadFunc = make_loader(args)
+
+    worker = multiprocessing.parent_process() is not None
+    if worker:
+        profile.reset()
+
+    recorder = RecordingWriter()
+    errors = []
+    id = -1
+    for lat, lon in points:
+        mark = len(recorder.elements)
+        try:
+            id = digitize(args, lat, lon, loadFunc, recorder, id)
+        except Exception:
+            del recorder.elements[mark:]
+            errors.append((lat, lon, traceback.format_exc()))
+
+    return recorder, -1 - id, errors, profile.take() if worker else None
+
+def main(argv=None):
+    args = get_args(argv)
+
+    points = read_points(args.input)
+    tasks = [(args, group) for group in group_points(points, args)]
+    print('lakkavokka: %d points in %d groups' % (len(points), len(tasks)), file=sys.stderr)
+
+    if args.workers > 1 and len(tasks) > 1:
+        pool = ProcessPoolExecutor(max_workers=args.workers)
+        results = pool.map(process_group, tasks)
+    else:
+        pool = None
+        results = map(process_group, tasks)
+
+    ways = failed = 0
+    try:
+        with profiled(args.profile, args.cprofile), \
+             open_output(args.output) as out, writers[args.format](out) as writer:
+            id = -1
+            for recorder, used, errors, report in results:
+                if report is not None:
+                    profile.merge(report)
+
+                # Shift ids of every group to keep them unique in the whole file
+                recorder.replay(writer, id + 1)
+                id -= used
+
+                for lat, lon, error in errors:
+                    print('lakkavokka: failed to digitize %f,%f\n%s' % (lat, lon, error), file=sys.stderr)
+                failed += len(errors)
+                ways += sum(1 for element in recorder.elements if element[0] == 'way')
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    print('lakkavokka: %d ways, %d points failed' % (ways, failed), file=sys.stderr)
+    return 1 if failed else 0
@@ -0,0 +1,489 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import sys
+
+import numpy as np
+import cv2 as cv
+from shapely.geometry import Polygon, MultiPolygon
+from shapely.ops import unary_union
+from shapely.validation import make_valid
+
+from lakkavokka import make_parser, make_loader, open_output, smoothing_methods, smoothing
+from lakkavokka.contours import pack_rgb, prepare_tags, parse_color, tile_size
+from lakkavokka.global_mercator import GlobalMercator
+from lakkavokka.load import load_tiles, openArchive, PaletteCheck
+from lakkavokka.mosaic import MosaicSource
+from lakkavokka.writer import writers
+from lakkavokka.instrument import profile, profiled
+
+"""
+Class value of pixels of missing tiles, it never matches a color or a label
+"""
+NODATA = 0xFFFFFFFF
+
+def get_args(argv=None):
+    usage = "usage: %prog bulk [options] --bbox <min_lon,min_lat,max_lon,max_lat> --class <color>:<tags>"
+    parser = make_parser(usage)
+
+    parser.add_option('--bbox', dest='bbox',
+                      type='str',
+                      help="Area to vectorize: min_lon,min_lat,max_lon,max_lat")
+
+    parser.add_option('-c', '--class', dest='classes',
+                      default=[], action='append', type='str',
+                      help="Color to vectorize and tags of its features, e.g. '#006400:natural=wood'. "
+                           "Palette index can be used instead of the color. Can be given several times")
+
+    parser.add_option('--block', dest='block',
+                      default=8, type='int',
+                      help="Size of the square block of tiles processed at once")
+
+    parser.add_option('--state', dest='state',
+                      default=None, type='str',
+                      help="SQLite file with tile hashes and features of the previous run. Only features around changed "
+                           "tiles are vectorized again and the output is an osmChange against the previous output. "
+                           "It refers to placeholder ids of the previous outputs and can't be applied to uploaded data")
+
+    parser.add_option('--smoothing', dest='smoothing',
+                      default=None, type='choice', choices=smoothing_methods,
+                      help="Smoothing of the boundaries before simplification: spline, chaikin, average, savgol "
+                           "(default with --topology) or none (default otherwise)")
+
+    parser.add_option('--topology', dest='topology',
+                      default=False, action='store_true',
+                      help="Trace features along pixel edges and write boundaries shared by adjacent features once, "
+                           "their ways refer to the same nodes")
+
+    (options, args) = parser.parse_args(argv)
+
+    if not options.bbox or not options.classes:
+        parser.print_usage()
+        print('--bbox and --class options are required')
+        exit(-1)
+
+    if options.state and options.format != 'osm':
+        parser.print_usage()
+        print('--state writes osmChange, it can not be used with --format %s' % options.format)
+        exit(-1)
+
+    if options.topology and options.format != 'osm':
+        parser.print_usage()
+        print('--topology writes OSM XML, it can not be used with --format %s' % options.format)
+        exit(-1)
+
+    if options.topology and options.state:
+        parser.print_usage()
+        print('--topology can not be used with --state')
+        exit(-1)
+
+    # Pixel edge staircases traced with --topology need smoothing more than
+    # pixel center contours do
+    if options.smoothing is None:
+        options.smoothing = 'savgol' if options.topology else 'none'
+
+    return options
+
+def parse_bbox(bbox):
+    min_lon, min_lat, max_lon, max_lat = map(float, bbox.split(','))
+    return min_lon, min_lat, max_lon, max_lat
+
+"""
+Parse '#rrggbb:k=v,k=v' or '<palette index>:k=v,k=v' into class value and tags
+"""
+def parse_class(spec):
+    value, _, tags = spec.partition(':')
+    return parse_color(value), prepare_tags(tags)
+
+"""
+Key classes by their values in tiles of the source. Mosaic tiles hold labels
+instead of colors, classes absent from the mosaic are dropped.
+"""
+def source_classes(source, classes):
+    archive = openArchive(source)
+    if isinstance(archive, MosaicSource):
+        return {archive.label(value): tags for value, tags in classes.items()
+                if archive.label(value) is not None}
+    return classes
+
+"""
+Range of tiles in Google (XYZ) notation covering the bbox
+"""
+def bbox_tiles(bbox, zoom):
+    min_lon, min_lat, max_lon, max_lat = bbox
+    proj = GlobalMercator()
+    tx0, ty0 = proj.MetersToTile(*proj.LatLonToMeters(min_lat, min_lon), zoom)
+    tx1, ty1 = proj.MetersToTile(*proj.LatLonToMeters(max_lat, max_lon), zoom)
+    return tx0, (2**zoom - 1) - ty1, tx1, (2**zoom - 1) - ty0
+
+"""
+Class values of the tile pixels: packed RGB colors or palette indices
+"""
+def tile_values(tile):
+    if tile.ndim == 3:
+        return pack_rgb(tile)
+    return tile.astype(np.uint32)
+
+"""
+Load class values of a range of tiles into a single array. Missing tiles
+are filled with NODATA. Loaded tiles are passed to check first, if given.
+"""
+def load_values(zoom, x0, y0, x1, y1, loadFunc, concurrency=1, check=None):
+    tiles = [(zoom, x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+    with profile.timer('tiles'):
+        images = load_tiles(tiles, loadFunc, concurrency)
+
+    with profile.timer('labels'):
+        values = np.full(((y1 - y0 + 1) * tile_size, (x1 - x0 + 1) * tile_size), NODATA, dtype=np.uint32)
+        for (_, x, y), image in zip(tiles, images):
+            if image is not None:
+                if check is not None:
+                    check(image)
+                row, col = (y - y0) * tile_size, (x - x0) * tile_size
+                values[row:row + tile_size, col:col + tile_size] = tile_values(image)
+
+    profile.count('tiles', len(tiles))
+    profile.count('pixels', values.size)
+    return values
+
+def polygon_parts(geometry):
+    if isinstance(geometry, Polygon):
+        return [geometry] if not geometry.is_empty else []
+    if isinstance(geometry, MultiPolygon):
+        return list(geometry.geoms)
+    return [g for part in getattr(geometry, 'geoms', []) for g in polygon_parts(part)]
+
+"""
+Contours of the mask along pixel edges instead of pixel centers. Pixels of
+the mask scaled twice are traced and contour points are mapped to the
+corners of the original pixels, so the diagonal steps at inner corners
+collapse to a single point. Vertices are integer pixel corners shifted by
+offset, without repeated and collinear points. Also returns a pixel of the
+mask on every contour as (col, row).
+"""
+def trace_cracks(mask, offset_x, offset_y):
+    contours, hierarchy = cv.findContours(cv.resize(mask, None, fx=2, fy=2, interpolation=cv.INTER_NEAREST),
+                                          cv.RETR_CCOMP, cv.CHAIN_APPROX_NONE)
+    cracks = []
+    for contour in contours:
+        points = (contour[:, 0, :] + 1) // 2 + (offset_x, offset_y)
+        points = points[np.any(points != np.roll(points, 1, axis=0), axis=1)]
+        turns = np.any(np.roll(points, -1, axis=0) - points != points - np.roll(points, 1, axis=0), axis=1)
+        cracks.append(points[turns][:, None, :])
+    return cracks, hierarchy, [contour[0, 0] // 2 for contour in contours]
+
+"""
+Polygons of the binary mask, each with a pixel of the mask on its outer
+contour as (col, row). Vertices are pixel centers shifted by offset, or
+pixel corners with cracks.
+"""
+def trace_polygons(mask, offset_x, offset_y, cracks=False):
+    if cracks:
+        contours, hierarchy, starts = trace_cracks(mask, offset_x, offset_y)
+    else:
+        contours, hierarchy = cv.findContours(mask, cv.RETR_CCOMP, cv.CHAIN_APPROX_NONE, offset=(offset_x, offset_y))
+        starts = [contour[0, 0] - (offset_x, offset_y) for contour in contours]
+    if hierarchy is None:
+        return []
+
+    hierarchy = hierarchy[0]
+    polygons = []
+    for i, (_, _, child, parent) in enumerate(hierarchy):
+        if parent != -1 or len(contours[i]) < 3:
+            continue
+
+        holes = []
+        while child != -1:
+            if len(contours[child]) >= 3:
+                holes.append(contours[child][:, 0, :])
+            child = hierarchy[child][0]
+
+        polygon = Polygon(contours[i][:, 0, :], holes)
+        if not polygon.is_valid:
+            # Holes of pixel center contours may touch or cross the shell
+            # along one pixel wide walls, subtract them instead
+            polygon = make_valid(Polygon(contours[i][:, 0, :]))
+            if holes:
+                polygon = polygon.difference(unary_union([make_valid(Polygon(hole)) for hole in holes]))
+        polygons.extend((p, tuple(starts[i])) for p in polygon_parts(polygon) if p.area > 0)
+
+    return polygons
+
+def union_bounds(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+"""
+Streams features of the given classes over a large area. The area is
+processed in blocks of tiles row by row. Every block is traced together with
+the last pixel row and column of its already processed neighbours, so
+polygons of adjacent blocks share the seam. A feature is an 8-connected
+component of the pixels of a class, the connectivity cv.findContours uses:
+components get ids in every block and ids of components sharing seam pixels
+are joined by a union-find, so features and their polygons don't depend on
+the block size. Features are kept by the id of their component and written
+as soon as no unprocessed block can touch them, so memory is bounded by the
+block size and the features crossing the current block row.
+"""
+class BulkVectorizer(object):
+    # Trace polygons along pixel edges instead of pixel centers
+    cracks = False
+
+    def __init__(self, zoom, classes, loadFunc, writer, simplify_tolerance_factor=0, tags={}, concurrency=1, block=8,
+                 smoothing_method='none'):
+        self.zoom = zoom
+        self.classes = classes
+        self.loadFunc = loadFunc
+        self.writer = writer
+        self.simplify_tolerance_factor = simplify_tolerance_factor
+        self.tags = tags
+        self.concurrency = concurrency
+        self.block = block
+        self.smoothing_method = smoothing_method
+        self.check = PaletteCheck()
+
+        self.proj = GlobalMercator()
+        # Features by component id, the union-find parents of component ids
+        # joined in the current block row and the next free id
+        self.features = {}
+        self.parent = {}
+        self.next_id = 0
+        self.id = -1
+        self.written = 0
+
+    def run(self, x0, y0, x1, y1):
+        width = (x1 - x0 + 1) * tile_size
+        top_border = top_ids = None
+
+        for by0 in range(y0, y1 + 1, self.block):
+            by1 = min(by0 + self.block - 1, y1)
+            bottom_border = np.empty(width, dtype=np.uint32)
+            bottom_ids = np.empty(width, dtype=np.int64)
+            left_border = left_ids = None
+
+            # Only the seam with the previous block row refers to components
+            # joined there, keep their roots and start over
+            if top_ids is not None:
+                top_ids = self.resolve(top_ids)
+            self.parent = {}
+
+            for bx0 in range(x0, x1 + 1, self.block):
+                bx1 = min(bx0 + self.block - 1, x1)
+                values = load_values(self.zoom, bx0, by0, bx1, by1, self.loadFunc, self.concurrency, self.check)
+                height, block_width = values.shape
+                col = (bx0 - x0) * tile_size
+
+                # Extend the block by the last row and column of processed neighbours
+                has_top, has_left = top_border is not None, left_border is not None
+                extended = np.empty((height + has_top, block_width + has_left), dtype=np.uint32)
+                extended[has_top:, has_left:] = values
+                ids = np.full(extended.shape, -1, dtype=np.int64)
+                if has_left:
+                    extended[has_top:, 0] = left_border
+                    ids[has_top:, 0] = left_ids
+                if has_top:
+                    extended[0, :] = top_border[col - has_left:col + block_width]
+                    ids[0, :] = top_ids[col - has_left:col + block_width]
+
+                self.add_block(extended, bx0 * tile_size - has_left, by0 * tile_size - has_top, ids)
+
+                left_border, left_ids = values[:, -1].copy(), ids[has_top:, -1].copy()
+                bottom_border[col:col + block_width] = values[-1, :]
+                bottom_ids[col:col + block_width] = ids[-1, has_left:]
+                self.flush(
+                    block_right=(bx1 + 1) * tile_size - 1 if bx1 < x1 else None,
+                    row_top=by0 * tile_size,
+                    row_bottom=(by1 + 1) * tile_size - 1 if by1 < y1 else None)
+
+            top_border, top_ids = bottom_border, bottom_ids
+
+        self.flush(None, 0, None)
+
+    """
+    Trace the block and merge its components with the features of processed
+    blocks. ids holds component ids of the seam pixels of processed blocks
+    and -1 elsewhere, component ids of the classified pixels of the last row
+    and column of the block are set in it for the next blocks. Features are kept for every component, also for
+    the ones without polygons yet (one pixel wide lines), with bounds of
+    their pixels, so a component is not written while it can still continue.
+    """
+    def add_block(self, values, offset_x, offset_y, ids):
+        touched = set()
+        for value in self.classes:
+            mask = (values == value).astype(np.uint8)
+            if not mask.any():
+                continue
+
+            with profile.timer('trace'):
+                polygons = trace_polygons(mask, offset_x, offset_y, self.cracks)
+                count, labels, stats, _ = cv.connectedComponentsWithStats(mask, connectivity=8, ltype=cv.CV_32S)
+
+            with profile.timer('merge'):
+                # Component ids of the block are base + label, label 0 is the background
+                base = self.next_id - 1
+                for x, y, w, h in stats[1:, :4].tolist():
+                    self.features[self.next_id] = {
+                        'value': value, 'parts': [],
+                        'bounds': (offset_x + x, offset_y + y, offset_x + x + w - 1, offset_y + y + h - 1)}
+                    touched.add(self.next_id)
+                    self.next_id += 1
+
+                # Components continuing components of processed blocks
+                old = np.concatenate([ids[0, :], ids[1:, 0]])
+                new = np.concatenate([labels[0, :], labels[1:, 0]])
+                seam = (old >= 0) & (new > 0)
+                for id, label in set(zip(old[seam].tolist(), new[seam].tolist())):
+                    self.union(id, base + label)
+
+                row, col = labels[-1, :], labels[:, -1]
+                ids[-1, row > 0] = row[row > 0] + base
+                ids[col > 0, -1] = col[col > 0] + base
+
+                for polygon, (x, y) in polygons:
+                    self.features[self.find(base + int(labels[y, x]))]['parts'].append(polygon)
+
+        with profile.timer('merge'):
+            for id in {self.find(id) for id in touched}:
+                feature = self.features[id]
+                parts = feature['parts']
+                if len(parts) > 1:
+                    feature['parts'] = parts = [unary_union(parts)]
+                feature['geometry'] = parts[0] if parts else None
+                if parts:
+                    feature['bounds'] = union_bounds(feature['bounds'], parts[0].bounds)
+
+    def find(self, id):
+        root = id
+        while root in self.parent:
+            root = self.parent[root]
+        while id != root:
+            self.parent[id], id = root, self.parent[id]
+        return root
+
+    """
+    Join two components and their features
+    """
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        self.parent[b] = a
+        feature, other = self.features[a], self.features.pop(b)
+        feature['parts'] += other['parts']
+        feature['bounds'] = union_bounds(feature['bounds'], other['bounds'])
+
+    """
+    Roots of an array of component ids
+    """
+    def resolve(self, ids):
+        unique, inverse = np.unique(ids, return_inverse=True)
+        return np.array([self.find(int(id)) for id in unique], dtype=np.int64)[inverse].reshape(ids.shape)
+
+    """
+    Write features which can't be touched by any unprocessed block. Blocks to
+    the right in the current row start at block_right column, the next row
+    starts at row_bottom; None means there are no such blocks.
+    """
+    def flush(self, block_right, row_top, row_bottom):
+        remaining = {}
+        for id, feature in self.features.items():
+            minx, miny, maxx, maxy = feature['bounds']
+            if (row_bottom is not None and maxy >= row_bottom) or \
+               (block_right is not None and maxx >= block_right and maxy >= row_top - 1):
+                remaining[id] = feature
+            elif feature['geometry'] is not None:
+                self.write(feature)
+        self.features = remaining
+
+    def write(self, feature):
+        polygons = self.polygons(feature)
+        if polygons:
+            with profile.timer('output'):
+                self.id = self.writer.polygon(self.id, polygons, self.feature_tags(feature))
+            self.written += 1
+
+    """
+    Simplified polygons of the feature as a list of (exterior, interiors)
+    closed (lat, lon) rings. Rings are normalized first, so smoothing and
+    simplification don't depend on where tracing started them.
+    """
+    def polygons(self, feature):
+        geometry = feature['geometry'].normalize()
+        if self.smoothing_method != 'none':
+            with profile.timer('smoothing'):
+                geometry = MultiPolygon([self.smooth(polygon) for polygon in polygon_parts(geometry)])
+        if self.simplify_tolerance_factor:
+            with profile.timer('simplify'):
+                geometry = geometry.simplify(self.simplify_tolerance_factor)
+
+        polygons = []
+        for polygon in polygon_parts(geometry):
+            if polygon.area == 0:
+                continue
+            exterior = self.to_latlon(polygon.exterior.coords)
+            interiors = [self.to_latlon(ring.coords) for ring in polygon.interiors]
+            polygons.append((exterior, interiors))
+        return polygons
+
+    def smooth(self, polygon):
+        rings = [np.asarray(ring.coords, dtype=float) for ring in [polygon.exterior] + list(polygon.interiors)]
+        rings = [smoothing.backends[self.smoothing_method](ring, True) for ring in rings]
+        return Polygon(rings[0], rings[1:])
+
+    def feature_tags(self, feature):
+        return dict(self.tags, **self.classes[feature['value']])
+
+    """
+    Convert global raster pixel coordinates (pixel centers, y pointing down)
+    to an array of (lat, lon)
+    """
+    def to_latlon(self, coords):
+        coords = np.asarray(coords)
+        px = coords[:, 0] + 0.5
+        py = tile_size * 2**self.zoom - coords[:, 1] - 0.5
+        lat, lon = self.proj.PixelsToLatLonArray(px, py, self.zoom)
+        return np.stack([lat, lon], axis=1)
+
+def main(argv=None):
+    args = get_args(argv)
+
+    classes = source_classes(args.source, dict(parse_class(spec) for spec in args.classes))
+    x0, y0, x1, y1 = bbox_tiles(parse_bbox(args.bbox), args.zoom)
+    loadFunc = make_loader(args)
+
+    print('lakkavokka: vectorizing %dx%d tiles' % (x1 - x0 + 1, y1 - y0 + 1), file=sys.stderr)
+
+    if args.state:
+        from lakkavokka.incremental import run
+        return run(args, classes, prepare_tags(args.tags), x0, y0, x1, y1, loadFunc)
+
+    vectorizer_type = BulkVectorizer
+    if args.topology:
+        from lakkavokka.topology import TopologyVectorizer
+        vectorizer_type = TopologyVectorizer
+
+    with profiled(args.profile, args.cprofile), \
+         open_output(args.output) as out, writers[args.format](out) as writer:
+        vectorizer = vectorizer_type(args.zoom, classes, loadFunc, writer, args.simplify_tolerance_factor,
+                                     prepare_tags(args.tags), args.concurrency, args.block, args.smoothing)
+        vectorizer.run(x0, y0, x1, y1)
+
+    print('lakkavokka: %d features' % vectorizer.written, file=sys.stderr)
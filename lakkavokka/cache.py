@@ -0,0 +1,185 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from lakkavokka.instrument import profile
+
+"""
+In-process LRU cache of decoded tiles bounded by the total size of the cached
+arrays. Cached arrays are shared between callers and marked read-only.
+"""
+class TileCache(object):
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.tiles:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+
+    def put(self, key, tile):
+        nbytes = self._nbytes(tile)
+        if nbytes > self.max_bytes:
+            return
+        if hasattr(tile, 'setflags'):
+            tile.setflags(write=False)
+
+        with self.lock:
+            if key in self.tiles:
+                self.size -= self._nbytes(self.tiles.pop(key))
+            self.tiles[key] = tile
+            self.size += nbytes
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            _, tile = self.tiles.popitem(last=False)
+            self.size -= self._nbytes(tile)
+            self.evictions += 1
+
+    @staticmethod
+    def _nbytes(tile):
+        return tile.nbytes if tile is not None else 0
+
+    """
+    Wrap a loader function (zoom, x, y) -> array. Tiles of different sources
+    are cached under different keys. A stamp function (zoom, x, y) -> value,
+    e.g. the tile file modification time, is a part of the key, so a changed
+    tile is loaded again and the old entry is evicted in time.
+    """
+    def wrap(self, loadFunc, source, stamp=None):
+        def load(zoom, x, y):
+            key = (source, zoom, x, y)
+            if stamp is not None:
+                key += (stamp(zoom, x, y),)
+            try:
+                tile = self.get(key)
+                profile.count('tile_cache_hits')
+                return tile
+            except KeyError:
+                pass
+            profile.count('tile_cache_misses')
+            tile = loadFunc(zoom, x, y)
+            self.put(key, tile)
+            return tile
+        return load
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'tiles': len(self.tiles),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+            }
+
+"""
+In-process LRU cache of per-patch click results: class values of a patch and
+contours of a class traced in it, so further clicks in the same patch skip
+loading and tracing. Contour entries are dicts keeping their size under
+'nbytes', they are not marked read-only.
+"""
+class PatchCache(TileCache):
+    @staticmethod
+    def _nbytes(entry):
+        if isinstance(entry, dict):
+            return entry['nbytes']
+        return TileCache._nbytes(entry)
+
+"""
+On-disk store of downloaded tiles. Every tile is kept with ETag and
+Last-Modified validators of the response so it can be revalidated with
+a conditional request instead of being downloaded again.
+"""
+class TileStore(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, url):
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest[2:])
+
+    def validators(self, url):
+        try:
+            with open(self.path(url) + '.json') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def read(self, url):
+        with open(self.path(url), 'rb') as f:
+            return f.read()
+
+    def write(self, url, content, etag=None, last_modified=None):
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to temporary files first so concurrent readers never see
+        # a partially written tile
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+        with open(tmp, 'w') as f:
+            json.dump({'url': url, 'etag': etag, 'last_modified': last_modified}, f)
+        os.replace(tmp, path + '.json')
+
+"""
+Process-wide tile cache. It lives as long as the process does, so it is
+reused between requests in `lakkavokka serve` mode.
+"""
+tile_cache = TileCache()
+
+"""
+Process-wide patch cache, reused between clicks like the tile cache
+"""
+patch_cache = PatchCache(64 * 1024 * 1024)
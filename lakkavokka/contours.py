@@ -20,214 +20,661 @@
 # SOFTWARE.
 ################################################################################
 
-from shapely.geometry import Point, LineString, box
-from shapely.ops import transform, linemerge
+from shapely.geometry import LineString
+
+import heapq
+import threading
 
-import pyproj
 import numpy as np
 import cv2 as cv
-import scipy.interpolate as si
-
-from bs4 import Tag
 
 from lakkavokka.global_mercator import GlobalMercator
+from lakkavokka.load import load_tiles, tile_palette, expand_palette, PaletteCheck, PaletteError
+from lakkavokka.cache import patch_cache
+from lakkavokka.instrument import profile
+from lakkavokka import smoothing
 
 tile_size = 256
 
 """
-Remove self-intersections from the LineString
+Remove loops from the line given as an (n, 2) array of integer vertices. When
+the line comes back to a vertex it has already visited, the part between the
+visits is dropped. Vertices are hashed as packed 64-bit integers.
 """
-def remove_self_intersaction(ls:LineString) -> LineString:
-    assert type(ls) is LineString
-
-    #pass 1
-    cache = {}
-    for i, p in enumerate(ls.coords[:-1]):
-        cache.setdefault(p, []).append(i)
+def remove_self_intersaction(line):
+    keys = (line[:, 0].astype(np.int64) << 32) | (line[:, 1].astype(np.int64) & 0xFFFFFFFF)
 
-    #pass 2
-    coords = []
-    i = 0
-    while i < len(ls.coords):
-        p = ls.coords[i]
-        if p in cache:
-            max_pos = max(cache[p])
-        else:
-            max_pos = i
+    # Index of the last visit of every vertex, the end of the line excluded
+    unique, first, inverse = np.unique(keys[:-1], return_index=True, return_inverse=True)
+    if len(unique) == len(line) - 1:
+        return line
 
-        if max_pos > i:
-            i = max_pos + 1
-        else:
-            i += 1
+    last = np.zeros(len(unique), dtype=np.intp)
+    np.maximum.at(last, inverse.reshape(-1), np.arange(len(line) - 1))
+    jump = np.append(last[inverse.reshape(-1)], len(line) - 1).tolist()
 
-        coords.append(p)
-    return LineString(coords)
+    keep = []
+    i = 0
+    while i < len(line):
+        keep.append(i)
+        i = max(jump[i], i) + 1
+    return line[keep]
 
 
 """
-Remove contour parts intersecting bbox
+Parts of the contour which don't lie on the edge of the patch as arrays of
+vertices. Where the contour runs along the edge, the region continues beyond
+the patch, so the contour is cut there. Single vertices between edge runs are
+dropped. A contour not touching the edge is returned as a closed ring.
 """
-def split_contour_inside_bbox(contour, bbox):
-    segments = []
-    buffer = []
-    contour = contour.tolist()
-    for x, y in contour + [contour[0]]:
-        p = Point(x, y)
+def split_contour_inside_bbox(contour, width, height):
+    x, y = contour[:, 0], contour[:, 1]
+    on_edge = (x == 0) | (x == width - 1) | (y == 0) | (y == height - 1)
 
-        if bbox.contains(p):
-            if len(buffer) > 1:
-                segments.append(LineString(buffer))
-                buffer = []
-        else:
-            buffer.append(p)
+    edge = np.flatnonzero(on_edge)
+    if not len(edge):
+        return [np.concatenate([contour, contour[:1]])]
 
-    #Add last buffer
-    if len(buffer) > 1:
-        segments.append(LineString(buffer))
+    # Start at an edge vertex, so the part crossing the end of the contour
+    # array is joined with its beginning
+    contour = np.roll(contour, -edge[0], axis=0)
+    inside = np.concatenate([[False], ~np.roll(on_edge, -edge[0]), [False]])
 
-    #Merge connected segments
-    mls = linemerge(segments)
-    if type(mls) == LineString:
-        return [mls]
-    else:
-        return mls.geoms
+    changes = np.flatnonzero(inside[1:] != inside[:-1])
+    starts, ends = changes[0::2], changes[1::2]
+    return [contour[start:end] for start, end in zip(starts.tolist(), ends.tolist()) if end - start > 1]
+
+
+"""
+Distance from the point to the polyline given as an (n, 2) array
+"""
+def polyline_distance(line, px, py):
+    a = line[:-1].astype(float)
+    ab = line[1:] - a
+    ap = np.array([px, py]) - a
+
+    length = (ab ** 2).sum(axis=1)
+    t = np.clip((ap * ab).sum(axis=1) / np.where(length > 0, length, 1), 0, 1)
+    return np.hypot(*(ap - t[:, None] * ab).transpose()).min()
 
 def generateTilesPatch(zoom:int, x:int, y:int, offset:int):
+    return generateTilesRange(zoom, x - offset, y - offset, x + offset, y + offset)
+
+"""
+Rows of tiles from (x0, y0) top-left to (x1, y1) bottom-right tile inclusive
+"""
+def generateTilesRange(zoom:int, x0:int, y0:int, x1:int, y1:int):
     rows = []
 
-    for yy in range(y - offset, y + offset + 1):
-        rows.append(list([(zoom, xx, yy) for xx in range(x - offset, x + offset + 1)]))
+    for yy in range(y0, y1 + 1):
+        rows.append(list([(zoom, xx, yy) for xx in range(x0, x1 + 1)]))
 
     return rows
 
-def load_mask(zoom, x, y, offset, loadFunc):
-    tiles = generateTilesPatch(zoom, x, y, offset)
+def load_mask(zoom, x, y, offset, loadFunc, concurrency=1, background=0):
+    return load_range(zoom, x - offset, y - offset, x + offset, y + offset, loadFunc, concurrency, background)
 
-    rows = []
-    for row in tiles:
-        images = list(map(lambda t: loadFunc(*t), row))
-        rows.append(np.concatenate(images, 1))
+"""
+Load a range of tiles into a single array. The array is allocated once on
+the first loaded tile and every tile is copied into its window as soon as it
+is loaded, so decoded tiles are not kept until the whole range is loaded.
+Palette tiles sharing one palette are kept as palette indices. If palettes
+of the tiles differ or palette and RGB tiles are mixed, palette tiles are
+expanded to RGB through their own palettes and the tiles are compared by
+color. Missing tiles are filled with the background: a packed RGB color for
+RGB tiles or a palette index for palette tiles.
+"""
+def load_range(zoom, x0, y0, x1, y1, loadFunc, concurrency=1, background=0):
+    tiles = [t for row in generateTilesRange(zoom, x0, y0, x1, y1) for t in row]
+    height, width = (y1 - y0 + 1) * tile_size, (x1 - x0 + 1) * tile_size
+
+    # The array, the palette of its indices and the palette of the first
+    # palette tile, background indices refer to it
+    patch = {}
+    missing = []
+    lock = threading.Lock()
+
+    def place(zoom, x, y):
+        tile = loadFunc(zoom, x, y)
+        if tile is None:
+            missing.append((x, y))
+            return
+
+        if tile.shape[:2] != (tile_size, tile_size):
+            raise ValueError('Tile %d/%d/%d is %dx%d pixels, expected %dx%d' % (
+                zoom, x, y, tile.shape[1], tile.shape[0], tile_size, tile_size))
+
+        palette = tile_palette(tile)
+        row, col = (y - y0) * tile_size, (x - x0) * tile_size
+        with lock:
+            if not patch:
+                patch['image'] = np.empty((height, width) + tile.shape[2:], dtype=tile.dtype)
+                patch['palette'] = palette
+            if patch.get('first_palette') is None:
+                patch['first_palette'] = palette
+            image = patch['image']
+
+            if image.ndim == 2 and (tile.ndim != 2 or (palette is None) != (patch['palette'] is None) or
+                                    (palette is not None and not np.array_equal(palette, patch['palette']))):
+                if patch['palette'] is None:
+                    raise ValueError('Tiles of the source mix mosaic labels and images, '
+                                     'their classes can not be matched')
+                profile.count('palette_mismatches')
+                image = patch['image'] = expand_palette(image, patch['palette'])
+                patch['palette'] = None
+
+            if image.ndim == 3 and tile.ndim == 2:
+                if palette is None:
+                    raise ValueError('Tiles of the source mix mosaic labels and images, '
+                                     'their classes can not be matched')
+                tile = expand_palette(tile, palette)
+            image[row:row + tile_size, col:col + tile_size] = tile
+
+    with profile.timer('tiles'):
+        load_tiles(tiles, place, concurrency)
+
+        if patch:
+            image = patch['image']
+        else:
+            image = np.empty((height, width), dtype=np.min_scalar_type(background))
+
+        if image.ndim == 3:
+            first_palette = patch.get('first_palette')
+            if first_palette is not None and background < len(first_palette):
+                background = tuple(first_palette[background])
+            else:
+                background = ((background >> 16) & 0xFF, (background >> 8) & 0xFF, background & 0xFF)
+        for x, y in missing:
+            row, col = (y - y0) * tile_size, (x - x0) * tile_size
+            image[row:row + tile_size, col:col + tile_size] = background
+
+    profile.count('tiles', len(tiles))
+    profile.count('tiles_background', len(missing))
+    profile.count('pixels', height * width)
+    return image
 
-    return np.concatenate(rows, 0)
+"""
+Pack RGB colors into 24-bit integers, one per pixel
+"""
+def pack_rgb(rgb):
+    return (rgb[:,:,0].astype(np.uint32) << 16) | (rgb[:,:,1].astype(np.uint32) << 8) | rgb[:,:,2]
 
-def rgb2mask(rgb):
-    assert len(rgb.shape) == 3
-    height, width, ch = rgb.shape
-    assert ch == 3
+"""
+Class value of every pixel: packed RGB color for RGB images, palette index
+for palette images. Pixels of the same class have the same value in all
+tiles and at all zooms of a source.
+"""
+def class_values(image):
+    if image.ndim == 3:
+        return pack_rgb(image)
+    return image
 
-    binary_mask = (rgb[:,:,0] == 255) & (rgb[:,:,1] == 255) & (rgb[:,:,2] == 0)
+"""
+Find the connected region containing the clicked pixel by a flood fill from
+the click. Returns the region bounding box (x, y, w, h) and the region mask
+cropped to the bounding box with one pixel of zero padding.
+"""
+def seed_region(mask, click_x, click_y):
+    height, width = mask.shape
+    region = np.zeros((height + 2, width + 2), dtype=np.uint8)
 
-    flat = np.reshape(rgb, (height * width, ch))
-    colors = np.unique(flat, axis=0)
+    flags = 8 | cv.FLOODFILL_MASK_ONLY | (1 << 8)
+    _, _, _, rect = cv.floodFill(mask, region, (click_x, click_y), 1, 0, 0, flags)
 
-    mask = np.zeros((width, height), dtype=np.uint8)
+    # The flood fill mask has one pixel border, so the crop is already padded.
+    # floodFill sets the border to 1 though, clear it
+    x, y, w, h = rect
+    crop = region[y:y + h + 2, x:x + w + 2]
+    crop[0, :] = crop[-1, :] = crop[:, 0] = crop[:, -1] = 0
+    return rect, crop
 
-    for index, color in enumerate(colors):
-        feature_mask = np.where(np.all(rgb == color, axis = 2))
-        mask[feature_mask] = index
+"""
+Trace contours of the connected region containing the clicked pixel only.
+The work depends on the region size rather than on the patch size, and
+contours are traced inside the region bounding box. The clicked pixel always
+belongs to a region of its own class, so there is always a region to trace.
+"""
+def seed_region_contours(mask, click_x, click_y):
+    (x, y, w, h), region = seed_region(mask, click_x, click_y)
 
-    return mask
+    return cv.findContours(region, cv.RETR_CCOMP, cv.CHAIN_APPROX_NONE, offset=(x - 1, y - 1))
 
-def translate_line_string(zoom, container, id, ls, proj, offset_x, offset_y, width, height, tags):
-    cache = {}
-    nodes = []
-    for px, py in ls.coords:
-        py = 0.5 + height - py
-        px = 0.5 + px
-        px += offset_x
-        py += offset_y
+"""
+Position of the click inside the patch. Patches are (tx0, ty0, tx1, ty1)
+ranges of TMS tiles, the click is given in TMS pixel coordinates.
+"""
+def patch_click(patch, gx, gy):
+    tx0, ty0, tx1, ty1 = patch
+    click_x = gx - tile_size * tx0
+    click_y = tile_size * (ty1 + 1) - gy
 
-        mx, my = proj.PixelsToMeters(px, py, zoom)
-        lat, lon = proj.MetersToLatLon(mx, my)
+    click_x = min(max(click_x, 0), tile_size * (tx1 - tx0 + 1) - 1)
+    click_y = min(max(click_y, 0), tile_size * (ty1 - ty0 + 1) - 1)
+    return click_x, click_y
 
-        if (lat, lon) in cache:
-            nodes.append(cache[(lat, lon)])
+"""
+Load the patch and return class values of its pixels
+"""
+def load_class_values(zoom, patch, loadFunc, concurrency=1, background=0):
+    tx0, ty0, tx1, ty1 = patch
+    top = (2**zoom - 1) - ty1
+    image = load_range(zoom, tx0, top, tx1, top + ty1 - ty0, loadFunc, concurrency, background)
+
+    with profile.timer('labels'):
+        return class_values(image)
+
+"""
+Load the patch and return a binary mask of the given class value, of the
+class of the clicked pixel by default. The clicked pixel is always a part of
+the mask, so the clicked region can be found even if the pixel under the
+click has another color, e.g. a blend of classes at a coarser zoom.
+"""
+def load_class_mask(zoom, patch, gx, gy, loadFunc, concurrency=1, background=0, value=None):
+    values = load_class_values(zoom, patch, loadFunc, concurrency, background)
+
+    with profile.timer('labels'):
+        click_x, click_y = patch_click(patch, gx, gy)
+        if value is None:
+            value = values[click_y, click_x]
+
+        mask = (values == value).astype(np.uint8)
+        mask[click_y, click_x] = 1
+        return mask
+
+"""
+Start with the clicked tile and add tiles only in the directions where the
+clicked region touches the patch boundary. Stops when the region fits into
+the patch or when no more tiles can be added without exceeding max_tiles.
+"""
+def grow_patch(zoom, tx, ty, gx, gy, loadFunc, max_tiles, concurrency=1, background=0, value=None):
+    loaded = {}
+    def load(zoom, x, y):
+        if (x, y) not in loaded:
+            loaded[(x, y)] = loadFunc(zoom, x, y)
+        return loaded[(x, y)]
+
+    patch = [tx, ty, tx, ty]
+    while True:
+        mask = load_class_mask(zoom, patch, gx, gy, load, concurrency, background, value)
+        with profile.timer('grow'):
+            (x, y, w, h), _ = seed_region(mask, *patch_click(patch, gx, gy))
+
+        height, width = mask.shape
+        tx0, ty0, tx1, ty1 = patch
+        touches = [
+            (0, -1, x == 0),            # left
+            (2, 1, x + w == width),     # right
+            (3, 1, y == 0),             # top
+            (1, -1, y + h == height),   # bottom
+        ]
+
+        grown = False
+        for side, step, touch in touches:
+            if not touch:
+                continue
+            candidate = list(patch)
+            candidate[side] += step
+            if (candidate[2] - candidate[0] + 1) * (candidate[3] - candidate[1] + 1) > max_tiles:
+                continue
+            patch = candidate
+            grown = True
+
+        if not grown:
+            return mask, tuple(patch)
+
+"""
+Find the clicked region at coarse_zoom first, over an area 2^(zoom -
+coarse_zoom) times wider than the same buffer covers at zoom, and build its
+mask at zoom loading only the tiles the coarse outline passes through. Tiles
+inside the coarse region are filled as the clicked class and tiles outside it
+as the background, so details smaller than a coarse pixel inside or outside
+the region are lost. Classes are matched by class values: colors of RGB
+tiles, so the coarse tiles may have a different set of colors, but palette
+indices of palette tiles, so both zooms must share the palette. Returns the
+mask and the TMS tile range it covers, or None if the click has to be
+traced at zoom: the clicked coarse tile is missing, the clicked class is the
+background, the coarse region touches the edge of the coarse patch (it is
+the large region around smaller ones, its outline would need most of the
+tiles anyway), its outline passes through more than max_tiles tiles or the
+tiles do not share one palette.
+"""
+def refine_patch(zoom, coarse_zoom, gx, gy, offset, loadFunc, max_tiles=0, concurrency=1, background=0):
+    scale = 2**(zoom - coarse_zoom)
+    if not 1 < scale <= tile_size:
+        raise ValueError('Coarse zoom must be from %d to %d' % (zoom - 8, zoom - 1))
+
+    check = PaletteCheck()
+    def load(zoom, x, y):
+        tile = loadFunc(zoom, x, y)
+        if tile is not None:
+            check(tile)
+        return tile
+
+    try:
+        return refine_region(zoom, coarse_zoom, gx, gy, offset, load, max_tiles, concurrency, background)
+    except PaletteError:
+        profile.count('coarse_fallbacks')
+        return None
+
+"""
+refine_patch for tiles checked to share one palette
+"""
+def refine_region(zoom, coarse_zoom, gx, gy, offset, loadFunc, max_tiles, concurrency, background):
+    scale = 2**(zoom - coarse_zoom)
+
+    # Clicked class at full resolution
+    col, row = gx, tile_size * 2**zoom - gy
+    tile = loadFunc(zoom, col // tile_size, row // tile_size)
+    if tile is None:
+        value = background
+    else:
+        value = class_values(tile)[row % tile_size, col % tile_size]
+
+    # Clicked region at the coarse zoom
+    cgx, crow = gx // scale, row // scale
+    cgy = tile_size * 2**coarse_zoom - crow
+    ctx, cty = cgx // tile_size, cgy // tile_size
+    if loadFunc(coarse_zoom, ctx, crow // tile_size) is None:
+        profile.count('coarse_missing')
+        return None
+    if max_tiles:
+        coarse_mask, coarse = grow_patch(coarse_zoom, ctx, cty, cgx, cgy, loadFunc, max_tiles, concurrency, background, value)
+    else:
+        coarse = (ctx - offset, cty - offset, ctx + offset, cty + offset)
+        coarse_mask = load_class_mask(coarse_zoom, coarse, cgx, cgy, loadFunc, concurrency, background, value)
+
+    click_x, click_y = patch_click(coarse, cgx, cgy)
+
+    with profile.timer('refine'):
+        (x, y, w, h), crop = seed_region(coarse_mask, click_x, click_y)
+        height, width = coarse_mask.shape
+        if value == background or x == 0 or y == 0 or x + w == width or y + h == height:
+            profile.count('coarse_fallbacks')
+            return None
+        region = np.zeros_like(coarse_mask)
+        region[y:y + h, x:x + w] = crop[1:-1, 1:-1]
+
+        # Coarse pixels next to the outline on both sides
+        kernel = np.ones((3, 3), dtype=np.uint8)
+        band = cv.dilate(region, kernel) - cv.erode(region, kernel)
+
+        # Full resolution tiles covering the coarse region, Google rows
+        left = tile_size * coarse[0]
+        top = tile_size * ((2**coarse_zoom - 1) - coarse[3])
+        x0, x1 = (left + x) * scale // tile_size, ((left + x + w) * scale - 1) // tile_size
+        y0, y1 = (top + y) * scale // tile_size, ((top + y + h) * scale - 1) // tile_size
+
+        mask = np.zeros(((y1 - y0 + 1) * tile_size, (x1 - x0 + 1) * tile_size), dtype=np.uint8)
+        step = tile_size // scale
+        boundary = []
+        for ty in range(y0, y1 + 1):
+            for tx in range(x0, x1 + 1):
+                cx, cy = tx * step - left, ty * step - top
+                if band[cy:cy + step, cx:cx + step].any():
+                    boundary.append((zoom, tx, ty))
+                elif region[cy, cx]:
+                    mask[(ty - y0) * tile_size:(ty - y0 + 1) * tile_size,
+                         (tx - x0) * tile_size:(tx - x0 + 1) * tile_size] = 1
+
+        if max_tiles and len(boundary) > max_tiles:
+            profile.count('coarse_fallbacks')
+            return None
+
+    def place(zoom, tx, ty):
+        tile = loadFunc(zoom, tx, ty)
+        window = mask[(ty - y0) * tile_size:(ty - y0 + 1) * tile_size,
+                      (tx - x0) * tile_size:(tx - x0 + 1) * tile_size]
+        if tile is None:
+            window[:] = value == background
         else:
-            nodes.append(id)
-            cache[(lat, lon)] = id
-            id -= 1
-            container.append(Tag(name="node", attrs={
-                "id": nodes[-1],
-                "lat": lat,
-                "lon": lon,
-                "version": 1
-            }))
-
-    way = Tag(name="way", attrs={
-        "id": id,
-        "version": 1
-    })
-    id -= 1
+            window[:] = class_values(tile) == value
 
-    for k, v in tags.items():
-        way.append(Tag(name="tag", attrs={'k': k, 'v': v}))
+    with profile.timer('tiles'):
+        load_tiles(boundary, place, concurrency)
+    profile.count('tiles', len(boundary))
+    profile.count('tiles_skipped', (y1 - y0 + 1) * (x1 - x0 + 1) - len(boundary))
+    profile.count('pixels', mask.size)
 
-    for node in nodes:
-        way.append(Tag(name="nd", attrs={
-            "ref": node
-        }))
+    return mask, (x0, (2**zoom - 1) - y1, x1, (2**zoom - 1) - y0)
+
+"""
+Project LineString given in patch pixels to lat/lon and write it as a way.
+Nodes at the same position are written once, ids are assigned in order of
+the first appearance.
+"""
+def translate_line_string(zoom, writer, id, ls, proj, offset_x, offset_y, width, height, tags):
+    coords = np.asarray(ls.coords)
+    px = 0.5 + coords[:, 0] + offset_x
+    py = 0.5 + height - coords[:, 1] + offset_y
+
+    lat, lon = proj.PixelsToLatLonArray(px, py, zoom)
+
+    _, first, inverse = np.unique(np.stack([lat, lon], axis=1), axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    nodes = (id - rank[inverse.reshape(-1)]).tolist()
+    for node_id, i in zip(range(id, id - len(order), -1), first[order].tolist()):
+        writer.node(node_id, lat[i], lon[i])
+    id -= len(order)
+
+    writer.way(id, nodes, tags)
+    id -= 1
 
-    container.append(way)
     return id
 
-def find_single_contour(zoom, tx, ty, click_x, click_y, offset, loadFunc, simplify_tolerance_factor=0, tags={}):
-    proj = GlobalMercator()
+"""
+Bounding boxes of all contours at once as arrays of (x, y) minimums and
+maximums
+"""
+def contour_bounds(contours):
+    lengths = np.fromiter(map(len, contours), dtype=np.intp, count=len(contours))
+    points = np.concatenate(contours)[:, 0, :]
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return np.minimum.reduceat(points, starts), np.maximum.reduceat(points, starts)
 
-    rgb = load_mask(zoom, tx, (2**zoom - 1) - ty, offset, loadFunc)
+"""
+Indices of contours with non-zero area in order of the distance from the
+click, ties in order of the contours. Contours are ranked lazily: the
+distance to the bounding box is a lower bound of the distance to the
+contour, so exact distances are computed only for contours which can still
+be the nearest one. With RETR_CCOMP hierarchy a hole is never nearer to a
+click outside its outer contour than the outer contour itself. Bounds from
+contour_bounds can be given if they are known, areas as a float array with
+NaN for areas not computed yet, it is filled in as areas are computed.
+"""
+def rank_regions(contours, hierarchy, click_x, click_y, bounds=None, areas=None):
+    if not len(contours):
+        return
+
+    with profile.timer('rank'):
+        lo, hi = bounds if bounds is not None else contour_bounds(contours)
+
+        click = np.array([click_x, click_y])
+        gap = np.maximum(np.maximum(lo - click, click - hi), 0)
+        # Keep bounds below exact distances despite rounding
+        bounds = np.hypot(gap[:, 0], gap[:, 1]) - 1e-6
+        order = np.lexsort((np.arange(len(contours)), bounds)).tolist()
+        bounds = bounds.tolist()
+
+        parents = hierarchy[0][:, 3].tolist() if hierarchy is not None else [-1] * len(contours)
+
+    exact = {}
+    ranked = []     # (distance, index) of contours with known distance
+    deferred = []   # (bound, index) of holes bounded by their outer contours
+    k = 0
+    while True:
+        with profile.timer('rank'):
+            candidate = None
+            if k < len(order):
+                candidate = (bounds[order[k]], order[k])
+            if deferred and (candidate is None or deferred[0] < candidate):
+                candidate = deferred[0]
+
+            if ranked and (candidate is None or ranked[0] < candidate):
+                _, i = heapq.heappop(ranked)
+            elif candidate is None:
+                return
+            else:
+                if deferred and candidate is deferred[0]:
+                    heapq.heappop(deferred)
+                else:
+                    k += 1
+
+                bound, i = candidate
+                parent = parents[i]
+                if parent != -1 and exact.get(parent, 0) < 0 and -exact[parent] - 1e-6 > bound:
+                    heapq.heappush(deferred, (-exact[parent] - 1e-6, i))
+                    continue
+
+                profile.count('exact_distances')
+                exact[i] = cv.pointPolygonTest(contours[i], (click_x, click_y), True)
+                if areas is None:
+                    area = cv.contourArea(contours[i])
+                else:
+                    if np.isnan(areas[i]):
+                        areas[i] = cv.contourArea(contours[i])
+                    area = areas[i]
+                if area > 0:
+                    heapq.heappush(ranked, (abs(exact[i]), i))
+                continue
+
+        yield i
+
+"""
+Trace contours of the mask, of the clicked region only with seed. Returns a
+dict with the mask shape, contours, their hierarchy and bounds and an array
+of their areas filled in by rank_regions.
+"""
+def trace_mask(mask, click_x, click_y, seed=False):
+    with profile.timer('trace'):
+        if seed:
+            contours, hierarchy = seed_region_contours(mask, click_x, click_y)
+        else:
+            contours, hierarchy = cv.findContours(mask, cv.RETR_CCOMP, cv.CHAIN_APPROX_NONE)
+        bounds = contour_bounds(contours) if len(contours) else None
+
+    traced = {
+        'shape': mask.shape,
+        'contours': contours,
+        'hierarchy': hierarchy,
+        'bounds': bounds,
+        'areas': np.full(len(contours), np.nan),
+    }
+    traced['nbytes'] = sum(c.nbytes for c in contours) + traced['areas'].nbytes + \
+        (hierarchy.nbytes if hierarchy is not None else 0) + \
+        (bounds[0].nbytes + bounds[1].nbytes if bounds is not None else 0)
+    return traced
 
-    mask = rgb2mask(rgb[:,:,0:3])
+"""
+Entry of the patch cache, made and stored on a miss. Keys start with the
+source, None source bypasses the cache.
+"""
+def cached(key, make):
+    if key[0] is None:
+        return make()
+    try:
+        entry = patch_cache.get(key)
+        profile.count('patch_cache_hits')
+        return entry
+    except KeyError:
+        profile.count('patch_cache_misses')
+    entry = make()
+    patch_cache.put(key, entry)
+    return entry
+
+"""
+Trace the patch around the click. Class values of the patch and contours of
+the clicked class are kept in the patch cache, so further clicks in the same
+patch only rank and output contours. Contours of the clicked region only
+(seed) depend on the click and are traced every time. Stamps of the patch
+tiles, e.g. modification times of their files, are a part of the key, so a
+patch with changed tiles is traced again.
+"""
+def trace_patch(zoom, patch, gx, gy, loadFunc, concurrency=1, background=0, seed=False, source=None, stamp=None):
+    key = (source, zoom, patch, background)
+    if stamp is not None:
+        tx0, ty0, tx1, ty1 = patch
+        key += tuple(stamp(zoom, x, (2**zoom - 1) - y) for y in range(ty0, ty1 + 1) for x in range(tx0, tx1 + 1))
+    values = cached(key, lambda: load_class_values(zoom, patch, loadFunc, concurrency, background))
 
-    bbox = box(0, 0, mask.shape[0] - 1, mask.shape[1] - 1).boundary
+    click_x, click_y = patch_click(patch, gx, gy)
+    value = values[click_y, click_x]
 
-    mask = (mask == mask[click_x, click_y]).astype(np.uint8)
+    def trace():
+        with profile.timer('labels'):
+            mask = (values == value).astype(np.uint8)
+        return trace_mask(mask, click_x, click_y, seed)
 
-    contours, hierarchy = cv.findContours(mask, cv.RETR_CCOMP, cv.CHAIN_APPROX_NONE)
+    if seed:
+        return trace()
+    return cached(key + (int(value),), trace)
 
-    regions = map(lambda ix: {
-            'idx': ix[0],
-            'area': cv.contourArea(ix[1]),
-            'dist': cv.pointPolygonTest(ix[1], (click_x, click_y), True)
-        }, enumerate(contours))
+"""
+Write the way nearest to the clicked point. Returns the next free id. With
+a source, results for the patch are cached in the patch cache under it.
+"""
+def find_single_contour(zoom, tx, ty, click_x, click_y, offset, loadFunc, writer, simplify_tolerance_factor=0, tags={}, concurrency=1, seed=False, max_tiles=0, id=-1, background=0, coarse_zoom=0, smoothing_method='spline', source=None, stamp=None):
+    proj = GlobalMercator()
 
-    regions = filter(lambda cnt: cnt['area'] > 0, regions)
+    # Click position in TMS pixel coordinates
+    gx = click_x + tile_size * (tx - offset)
+    gy = tile_size * (ty + offset + 1) - click_y
+
+    refined = None
+    if coarse_zoom:
+        refined = refine_patch(zoom, coarse_zoom, gx, gy, offset, loadFunc, max_tiles, concurrency, background)
+        seed = True
+
+    if refined is not None:
+        mask, patch = refined
+        traced = trace_mask(mask, *patch_click(patch, gx, gy), seed=True)
+    elif max_tiles:
+        mask, patch = grow_patch(zoom, tx, ty, gx, gy, loadFunc, max_tiles, concurrency, background)
+        traced = trace_mask(mask, *patch_click(patch, gx, gy), seed=True)
+    else:
+        patch = (tx - offset, ty - offset, tx + offset, ty + offset)
+        traced = trace_patch(zoom, patch, gx, gy, loadFunc, concurrency, background, seed, source, stamp)
 
-    # Find nearest click point
-    regions = sorted(regions, key=lambda r: abs(r['dist']))
+    click_x, click_y = patch_click(patch, gx, gy)
+    height, width = traced['shape']
+    contours, hierarchy = traced['contours'], traced['hierarchy']
 
-    osm = Tag(name='osm', attrs={"version": "0.6"})
+    profile.count('contours', len(contours))
+    profile.count('contour_vertices', sum(len(c) for c in contours))
 
-    id = -1
-    for region in regions:
-        contour = np.array(contours[region['idx']])
+    for idx in rank_regions(contours, hierarchy, click_x, click_y, traced['bounds'], traced['areas']):
+        contour = np.array(contours[idx])
         contour = np.squeeze(contour, 1)
 
-        line_strings = split_contour_inside_bbox(contour, bbox)
-        ls = min(line_strings, key=lambda ls: ls.distance(Point(click_x, click_y)))
-
-        if not ls.is_simple:
-            ls = remove_self_intersaction(ls)
+        with profile.timer('split'):
+            parts = split_contour_inside_bbox(contour, width, height)
+            if not parts:
+                # The whole contour goes along the patch edge
+                continue
+            contour = min(parts, key=lambda part: polyline_distance(part, click_x, click_y))
+            contour = remove_self_intersaction(contour)
 
-        closedWay = ls.is_ring
-        contour = np.array(ls.coords)
         if len(contour) <=3:
             continue
+        closedWay = bool((contour[0] == contour[-1]).all())
+        contour = contour.astype(float)
 
-        approxination_rate = 5
-        tck, u = si.splprep(contour.transpose(), s=approxination_rate)
-        splined_contour = si.splev(u, tck)
-        contour = np.array(splined_contour).transpose()
-
-        #Preserve topolgy
-        if closedWay:
-            contour = np.concatenate([contour, [contour[0]]])
+        profile.count('smoothed_vertices', len(contour))
+        with profile.timer('smoothing'):
+            contour = smoothing.backends[smoothing_method](contour, closedWay)
         ls = LineString(contour)
 
         if simplify_tolerance_factor:
-            ls = ls.simplify(simplify_tolerance_factor)
+            with profile.timer('simplify'):
+                ls = ls.simplify(simplify_tolerance_factor)
 
-        id = translate_line_string(zoom, osm, id, ls, proj, tile_size * (tx - offset), tile_size * (ty - offset), mask.shape[0] - 1, mask.shape[1] - 1, tags)
+        with profile.timer('output'):
+            id = translate_line_string(zoom, writer, id, ls, proj, tile_size * patch[0], tile_size * patch[1], width - 1, height - 1, tags)
+        profile.count('way_nodes', len(ls.coords))
         break
-    return osm
+    return id
 
 def prepare_tags(tags):
     result = {}
@@ -237,3 +684,12 @@ def prepare_tags(tags):
         k, v = pair.split("=")
         result[k.strip()] = v.strip()
     return result
+
+"""
+Parse '#rrggbb' color into a packed RGB integer or a decimal palette index
+"""
+def parse_color(value):
+    value = value.strip()
+    if value.startswith('#'):
+        return int(value[1:], 16)
+    return int(value)
@@ -0,0 +1,132 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import os
+import sys
+
+import numpy as np
+
+from lakkavokka import make_parser, make_loader
+from lakkavokka.bulk import parse_bbox, bbox_tiles, tile_values
+from lakkavokka.contours import tile_size
+from lakkavokka.load import load_tiles, PaletteCheck
+from lakkavokka.mosaic import write_header
+from lakkavokka.instrument import profiled
+
+def get_args(argv=None):
+    usage = "usage: %prog convert [options] --bbox <min_lon,min_lat,max_lon,max_lat> --output <tiles.mosaic>"
+    parser = make_parser(usage)
+
+    parser.add_option('--bbox', dest='bbox',
+                      type='str',
+                      help="Area to convert: min_lon,min_lat,max_lon,max_lat")
+
+    (options, args) = parser.parse_args(argv)
+
+    if not options.bbox or options.output == '-':
+        parser.print_usage()
+        print('--bbox and --output options are required')
+        exit(-1)
+
+    return options
+
+"""
+Assigns labels to class values in order of their first appearance, label 0
+is reserved for missing tiles
+"""
+class Labeler(object):
+    def __init__(self):
+        self.palette = []
+        self.labels = {}
+        self.check = PaletteCheck()
+
+    def __call__(self, tile):
+        self.check(tile)
+
+        values, inverse = np.unique(tile_values(tile), return_inverse=True)
+        for value in values.tolist():
+            if value not in self.labels:
+                if len(self.palette) == 0xFFFF:
+                    raise ValueError('More than %d classes can not be stored in a mosaic' % 0xFFFF)
+                self.palette.append(value)
+                self.labels[value] = len(self.palette)
+
+        lookup = np.array([self.labels[value] for value in values.tolist()], dtype=np.uint16)
+        return lookup[inverse].reshape(tile.shape[:2])
+
+"""
+Convert the tile range to labels. Labels are collected as uint16 in a
+temporary file, because the number of classes is known only at the end, and
+then written after the header with the smallest type fitting them.
+"""
+def convert(zoom, x0, y0, x1, y1, loadFunc, output, concurrency=1):
+    shape = (y1 - y0 + 1, x1 - x0 + 1, tile_size, tile_size)
+    tmp = '%s.%d.tmp' % (output, os.getpid())
+    labeler = Labeler()
+
+    blocks = np.memmap(tmp + '.labels', dtype=np.uint16, mode='w+', shape=shape)
+    try:
+        missing = 0
+        for y in range(y0, y1 + 1):
+            tiles = [(zoom, x, y) for x in range(x0, x1 + 1)]
+            for (_, x, _), tile in zip(tiles, load_tiles(tiles, loadFunc, concurrency)):
+                if tile is None:
+                    missing += 1
+                    blocks[y - y0, x - x0] = 0
+                else:
+                    blocks[y - y0, x - x0] = labeler(tile)
+
+        dtype = np.uint8 if len(labeler.palette) <= 0xFF else np.uint16
+        header = {
+            'zoom': zoom,
+            'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1,
+            'tile_size': tile_size,
+            'dtype': np.dtype(dtype).name,
+            'colors': labeler.colors or 'rgb',
+            'palette': labeler.palette,
+        }
+
+        with open(tmp, 'wb') as f:
+            write_header(f, header)
+            for row in blocks:
+                f.write(row.astype(dtype).tobytes())
+        os.replace(tmp, output)
+    finally:
+        del blocks
+        os.unlink(tmp + '.labels')
+
+    return len(labeler.palette), missing
+
+def main(argv=None):
+    args = get_args(argv)
+
+    x0, y0, x1, y1 = bbox_tiles(parse_bbox(args.bbox), args.zoom)
+    # Every tile is read once, caching decoded tiles would only waste memory
+    args.cache_size = 0
+    loadFunc = make_loader(args)
+
+    print('lakkavokka: converting %dx%d tiles' % (x1 - x0 + 1, y1 - y0 + 1), file=sys.stderr)
+
+    with profiled(args.profile, args.cprofile):
+        classes, missing = convert(args.zoom, x0, y0, x1, y1, loadFunc, args.output, args.concurrency)
+
+    print('lakkavokka: %d classes, %d missing tiles' % (classes, missing), file=sys.stderr)
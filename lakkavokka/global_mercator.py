@@ -23,6 +23,7 @@
 #******************************************************************************
 
 import math
+import numpy as np
 class GlobalMercator(object):
     r"""
     TMS Global Mercator Profile
@@ -199,6 +200,70 @@ class GlobalMercator(object):
         # coordinate origin is moved from bottom-left to top-left corner of the extent
         return tx, (2**zoom - 1) - ty
 
+    # Array variants of the conversions above. They accept scalars or NumPy
+    # arrays of any shape and convert all coordinates at once.
+
+    def LatLonToMetersArray(self, lat, lon):
+        "Converts arrays of lat/lon in WGS84 Datum to XY in Spherical Mercator EPSG:3857"
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        mx = lon * self.originShift / 180.0
+        my = np.log(np.tan((90 + lat) * np.pi / 360.0)) / (np.pi / 180.0)
+
+        my = my * self.originShift / 180.0
+        return mx, my
+
+    def MetersToLatLonArray(self, mx, my):
+        "Converts arrays of XY points from Spherical Mercator EPSG:3857 to lat/lon in WGS84 Datum"
+
+        lon = (np.asarray(mx, dtype=np.float64) / self.originShift) * 180.0
+        lat = (np.asarray(my, dtype=np.float64) / self.originShift) * 180.0
+
+        lat = 180 / np.pi * (2 * np.arctan(np.exp(lat * np.pi / 180.0)) - np.pi / 2.0)
+        return lat, lon
+
+    def PixelsToMetersArray(self, px, py, zoom):
+        "Converts arrays of pixel coordinates in given zoom level of pyramid to EPSG:3857"
+
+        res = self.Resolution(zoom)
+        mx = np.asarray(px, dtype=np.float64) * res - self.originShift
+        my = np.asarray(py, dtype=np.float64) * res - self.originShift
+        return mx, my
+
+    def MetersToPixelsArray(self, mx, my, zoom):
+        "Converts arrays of EPSG:3857 coordinates to pyramid pixel coordinates in given zoom level"
+
+        res = self.Resolution(zoom)
+        px = (np.asarray(mx, dtype=np.float64) + self.originShift) / res
+        py = (np.asarray(my, dtype=np.float64) + self.originShift) / res
+        return px, py
+
+    def PixelsToTileArray(self, px, py):
+        "Returns arrays of tiles covering given pixel coordinates"
+
+        tx = np.ceil(np.asarray(px) / float(self.tile_size)).astype(np.int64) - 1
+        ty = np.ceil(np.asarray(py) / float(self.tile_size)).astype(np.int64) - 1
+        return tx, ty
+
+    def MetersToTileArray(self, mx, my, zoom):
+        "Returns arrays of tiles for given mercator coordinates"
+
+        px, py = self.MetersToPixelsArray(mx, my, zoom)
+        return self.PixelsToTileArray(px, py)
+
+    def LatLonToPixelsArray(self, lat, lon, zoom):
+        "Converts arrays of lat/lon to pyramid pixel coordinates in given zoom level"
+
+        mx, my = self.LatLonToMetersArray(lat, lon)
+        return self.MetersToPixelsArray(mx, my, zoom)
+
+    def PixelsToLatLonArray(self, px, py, zoom):
+        "Converts arrays of pyramid pixel coordinates in given zoom level to lat/lon"
+
+        mx, my = self.PixelsToMetersArray(px, py, zoom)
+        return self.MetersToLatLonArray(mx, my)
+
     def QuadTree(self, tx, ty, zoom):
         "Converts TMS tile coordinates to Microsoft QuadTree"
 
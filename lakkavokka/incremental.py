@@ -0,0 +1,455 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import sys
+import json
+import sqlite3
+import hashlib
+
+import numpy as np
+import cv2 as cv
+from shapely import wkb
+
+from lakkavokka import open_output
+from lakkavokka.bulk import BulkVectorizer
+from lakkavokka.contours import tile_size
+from lakkavokka.load import load_tiles
+from lakkavokka.writer import OsmChangeWriter, RecordingWriter
+from lakkavokka.instrument import profile, profiled
+
+schema = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE tiles (x INTEGER, y INTEGER, hash BLOB, PRIMARY KEY (x, y));
+CREATE TABLE features (id INTEGER PRIMARY KEY, type TEXT, version INTEGER, value INTEGER,
+                       min_x REAL, min_y REAL, max_x REAL, max_y REAL, geometry BLOB, elements TEXT);
+CREATE INDEX features_bounds ON features (min_x, max_x);
+'''
+
+"""
+Hash of the tile content, tiles with the same pixels have the same hash
+whatever their encoding is. Missing tiles hash to an empty value.
+"""
+def tile_hash(tile):
+    if tile is None:
+        return b''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(('%s%r' % (tile.dtype.str, tile.shape)).encode('ascii'))
+    digest.update(np.ascontiguousarray(tile).tobytes())
+    return digest.digest()
+
+def hash_tiles(zoom, x0, y0, x1, y1, loadFunc, concurrency=1):
+    hashes = {}
+    for y in range(y0, y1 + 1):
+        tiles = [(zoom, x, y) for x in range(x0, x1 + 1)]
+        for (_, x, _), tile in zip(tiles, load_tiles(tiles, loadFunc, concurrency)):
+            with profile.timer('hash'):
+                hashes[(x, y)] = tile_hash(tile)
+    return hashes
+
+"""
+WKB of the geometry without collinear vertices and with rings in a canonical
+order and orientation, so the same pixel outline traced in differently
+aligned blocks gives the same bytes in most cases
+"""
+def canonical_wkb(geometry):
+    return wkb.dumps(geometry.simplify(0).normalize())
+
+def overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+"""
+Merge overlapping (x0, y0, x1, y1) boxes into their bounding boxes
+"""
+def merge_boxes(boxes):
+    boxes = list(boxes)
+    i = 0
+    while i < len(boxes):
+        for j in range(i + 1, len(boxes)):
+            if overlaps(boxes[i], boxes[j]):
+                a, b = boxes[i], boxes.pop(j)
+                boxes[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                i = 0
+                break
+        else:
+            i += 1
+    return sorted(boxes)
+
+"""
+Collects features of BulkVectorizer instead of writing them
+"""
+class FeatureCollector(BulkVectorizer):
+    def __init__(self, zoom, classes, loadFunc, simplify_tolerance_factor=0, tags={}, concurrency=1, block=8,
+                 smoothing_method='none'):
+        BulkVectorizer.__init__(self, zoom, classes, loadFunc, None, simplify_tolerance_factor, tags,
+                                concurrency, block, smoothing_method)
+        self.collected = []
+
+    def write(self, feature):
+        feature['wkb'] = canonical_wkb(feature['geometry'])
+        self.collected.append(feature)
+
+"""
+Tile hashes and features written by the previous runs of `lakkavokka bulk
+--state`. Every feature is kept with its geometry in global raster pixels,
+the id, type and version of its top element (a closed way or a multipolygon
+relation) and all of its elements in the compact() form, so a changed feature
+can be modified in place reusing its unchanged nodes and ways, and a
+vanished one deleted with all of its elements.
+"""
+class VectorState(object):
+    def __init__(self, path, options):
+        self.db = sqlite3.connect(path)
+        if not self.db.execute("SELECT name FROM sqlite_master WHERE name = 'meta'").fetchone():
+            self.db.executescript(schema)
+            self.db.executemany('INSERT INTO meta VALUES (?, ?)',
+                                [('options', json.dumps(options, sort_keys=True)), ('next_id', '-1')])
+            self.db.commit()
+
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        if json.loads(meta['options']) != json.loads(json.dumps(options, sort_keys=True)):
+            raise ValueError('state %s was made with other --bbox, --zoom, --class, --tags or --simplify-factor '
+                             'options, use a new state file' % path)
+        self.next_id = int(meta['next_id'])
+
+    def hashes(self):
+        return {(x, y): hash for x, y, hash in self.db.execute('SELECT x, y, hash FROM tiles')}
+
+    def update_hashes(self, hashes):
+        self.db.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?)',
+                            [(x, y, hash) for (x, y), hash in hashes.items()])
+
+    """
+    Features with bounds intersecting the pixel box (x0, y0, x1, y1)
+    """
+    def features(self, x0, y0, x1, y1):
+        rows = self.db.execute(
+            'SELECT id, type, version, value, min_x, min_y, max_x, max_y, geometry, elements FROM features '
+            'WHERE min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ?', (x1, x0, y1, y0))
+        return [{'id': id, 'type': type, 'version': version, 'value': value,
+                 'bounds': (min_x, min_y, max_x, max_y), 'wkb': geometry, 'elements': json.loads(elements)}
+                for id, type, version, value, min_x, min_y, max_x, max_y, geometry, elements in rows]
+
+    def remove(self, feature):
+        self.db.execute('DELETE FROM features WHERE id = ?', (feature['id'],))
+
+    def add(self, feature, version, elements):
+        type, id = elements[-1][:2]
+        self.db.execute('INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (id, type, version, int(feature['value'])) + tuple(map(float, feature['bounds'])) +
+                        (feature['wkb'], json.dumps([compact(element) for element in elements])))
+
+    def commit(self):
+        self.db.execute("UPDATE meta SET value = ? WHERE key = 'next_id'", (str(self.next_id),))
+        self.db.commit()
+
+"""
+Pair features of the previous run with the new ones. Features with the same
+class and canonical geometry are unchanged, the rest of the new features are
+paired with the old feature of the same class they overlap most. Returns
+lists of unchanged (old, new) pairs, modified (old, new) pairs, created new
+features and deleted old features.
+"""
+def match_features(old, new):
+    by_geometry = {}
+    for feature in old:
+        by_geometry.setdefault((feature['value'], feature['wkb']), []).append(feature)
+
+    unchanged, remaining = [], []
+    for feature in new:
+        same = by_geometry.get((feature['value'], feature['wkb']))
+        if same:
+            unchanged.append((same.pop(), feature))
+        else:
+            remaining.append(feature)
+    left = [f for features in by_geometry.values() for f in features]
+
+    pairs = []
+    for i, feature in enumerate(remaining):
+        for j, previous in enumerate(left):
+            if previous['value'] == feature['value'] and overlaps(previous['bounds'], feature['bounds']):
+                area = wkb.loads(previous['wkb']).intersection(feature['geometry']).area
+                if area > 0:
+                    pairs.append((-area, i, j))
+
+    modified, paired_new, paired_old = [], set(), set()
+    for _, i, j in sorted(pairs):
+        if i not in paired_new and j not in paired_old:
+            paired_new.add(i)
+            paired_old.add(j)
+            modified.append((left[j], remaining[i]))
+
+    created = [f for i, f in enumerate(remaining) if i not in paired_new]
+    deleted = [f for j, f in enumerate(left) if j not in paired_old]
+    return unchanged, modified, created, deleted
+
+"""
+Elements recorded by RecordingWriter without tags, which are the same for all
+features of a class, as JSON friendly lists
+"""
+def compact(element):
+    if element[0] == 'node':
+        return ['node', element[1], element[2], element[3]]
+    if element[0] == 'way':
+        return ['way', element[1], list(element[2])]
+    if element[0] == 'relation':
+        return ['relation', element[1], [list(member) for member in element[2]]]
+    return list(element)
+
+"""
+Give new member elements of a feature the ids of the old ones with the same
+content: nodes at the same position and ways with the same nodes. The top
+element takes the old top id. Returns the renumbered elements, the ones to
+create and the old elements to delete.
+"""
+def reuse_elements(old, new):
+    free = {}
+    for element in old[:-1]:
+        key = (element[0], element[2], element[3]) if element[0] == 'node' else (element[0], tuple(element[2]))
+        free.setdefault(key, []).append(element)
+
+    ids, elements, created = {}, [], []
+    for i, element in enumerate(new):
+        if element[0] == 'node':
+            key = ('node', element[2], element[3])
+        elif element[0] == 'way':
+            element = (element[0], element[1], [ids.get(ref, ref) for ref in element[2]], element[3])
+            key = ('way', tuple(element[2]))
+        else:
+            element = (element[0], element[1], [(type, ids.get(ref, ref), role) for type, ref, role in element[2]],
+                       element[3])
+
+        if i == len(new) - 1:
+            elements.append((element[0], old[-1][1]) + element[2:])
+        elif free.get(key):
+            ids[element[1]] = free[key].pop()[1]
+            elements.append((element[0], ids[element[1]]) + element[2:])
+        else:
+            elements.append(element)
+            created.append(element)
+
+    deleted = [element for same in free.values() for element in same]
+    return elements, created, deleted
+
+"""
+Re-vectorizes the area around changed tiles and writes the differences to
+the previous run as osmChange. Windows of tiles around changed tiles are
+grown until no feature of the previous run crosses their edges, then traced
+like `lakkavokka bulk` does. Tiles along the window edges are unchanged, so a
+feature crossing them would have crossed them in the previous run as well,
+and the features traced in a window are complete.
+"""
+class IncrementalVectorizer(object):
+    def __init__(self, state, zoom, classes, loadFunc, writer, simplify_tolerance_factor=0, tags={},
+                 concurrency=1, block=8, smoothing_method='none'):
+        self.state = state
+        self.zoom = zoom
+        self.classes = classes
+        self.loadFunc = loadFunc
+        self.writer = writer
+        self.simplify_tolerance_factor = simplify_tolerance_factor
+        self.tags = tags
+        self.concurrency = concurrency
+        self.block = block
+        self.smoothing_method = smoothing_method
+
+        self.counts = {'changed_tiles': 0, 'unchanged': 0, 'modified': 0, 'created': 0, 'deleted': 0}
+        self.modified = []
+        self.deleted = []
+
+    def run(self, x0, y0, x1, y1):
+        hashes = hash_tiles(self.zoom, x0, y0, x1, y1, self.loadFunc, self.concurrency)
+        previous = self.state.hashes()
+        changed = [tile for tile, hash in hashes.items() if previous.get(tile) != hash]
+        self.counts['changed_tiles'] = len(changed)
+
+        for window in self.windows(changed, (x0, y0, x1, y1)):
+            self.update(*window)
+
+        if self.modified:
+            self.writer.action('modify')
+        for element, version in self.modified:
+            write_elements(self.writer, [element], version)
+        self.write_deletes()
+
+        self.state.update_hashes({tile: hashes[tile] for tile in changed})
+
+    """
+    Windows of tiles to vectorize again: changed tiles with their neighbours,
+    grown to the bounds of the previous features they intersect
+    """
+    def windows(self, changed, extent):
+        if not changed:
+            return []
+        x0, y0, x1, y1 = extent
+
+        # Connected groups of changed tiles and their neighbours
+        grid = np.zeros((y1 - y0 + 1, x1 - x0 + 1), dtype=np.uint8)
+        for x, y in changed:
+            grid[y - y0, x - x0] = 1
+        grid = cv.dilate(grid, np.ones((3, 3), dtype=np.uint8))
+        count, _, stats, _ = cv.connectedComponentsWithStats(grid, connectivity=8)
+        windows = merge_boxes((x0 + left, y0 + top, x0 + left + width - 1, y0 + top + height - 1)
+                              for left, top, width, height, _ in stats[1:count].tolist())
+
+        while True:
+            grown = []
+            for window in windows:
+                for feature in self.state.features(*pixel_box(window)):
+                    minx, miny, maxx, maxy = (int(v) // tile_size for v in feature['bounds'])
+                    window = (min(window[0], minx), min(window[1], miny), max(window[2], maxx), max(window[3], maxy))
+                grown.append(window)
+            grown = merge_boxes(grown)
+            if grown == windows:
+                return windows
+            windows = grown
+
+    def update(self, x0, y0, x1, y1):
+        collector = FeatureCollector(self.zoom, self.classes, self.loadFunc, self.simplify_tolerance_factor,
+                                     self.tags, self.concurrency, self.block, self.smoothing_method)
+        collector.run(x0, y0, x1, y1)
+        old = self.state.features(*pixel_box((x0, y0, x1, y1)))
+
+        with profile.timer('match'):
+            unchanged, modified, created, deleted = match_features(old, collector.collected)
+        self.counts['unchanged'] += len(unchanged)
+
+        for feature in created:
+            self.create(collector, feature)
+
+        for previous, feature in modified:
+            self.state.remove(previous)
+            elements = self.record(collector, feature)
+            if elements is None:
+                self.delete(previous)
+            elif elements[-1][0] != previous['type']:
+                # A closed way became a multipolygon or the other way round
+                self.delete(previous)
+                self.create(collector, feature, elements)
+            else:
+                self.modify(previous, feature, elements)
+
+        for previous in deleted:
+            self.state.remove(previous)
+            self.delete(previous)
+
+    """
+    Elements of the feature with new ids, the top element last. None if the
+    feature vanishes after simplification.
+    """
+    def record(self, collector, feature):
+        polygons = collector.polygons(feature)
+        if not polygons:
+            return None
+        recorder = RecordingWriter()
+        self.state.next_id = recorder.polygon(self.state.next_id, polygons, collector.feature_tags(feature))
+        return recorder.elements
+
+    def create(self, collector, feature, elements=None):
+        elements = elements or self.record(collector, feature)
+        if elements is None:
+            return
+        self.writer.action('create')
+        write_elements(self.writer, elements)
+        self.state.add(feature, 1, elements)
+        self.counts['created'] += 1
+
+    def modify(self, previous, feature, elements):
+        elements, created, deleted = reuse_elements(previous['elements'], elements)
+        version = previous['version']
+        if compact(elements[-1]) != previous['elements'][-1]:
+            version += 1
+            self.modified.append((elements[-1], version))
+
+        if created:
+            self.writer.action('create')
+            write_elements(self.writer, created)
+        self.deleted.extend((element[0], element[1], 1) for element in deleted)
+        self.state.add(feature, version, elements)
+
+        # Different tracing of the same outline can give the same elements
+        if created or deleted or version != previous['version']:
+            self.counts['modified'] += 1
+        else:
+            self.counts['unchanged'] += 1
+
+    def delete(self, previous):
+        elements = previous['elements']
+        self.deleted.append((previous['type'], previous['id'], previous['version']))
+        self.deleted.extend((element[0], element[1], 1) for element in elements[:-1])
+        self.counts['deleted'] += 1
+
+    """
+    Deleted elements go after elements referring to them: relations, ways,
+    nodes
+    """
+    def write_deletes(self):
+        order = {'relation': 0, 'way': 1, 'node': 2}
+        for type, id, version in sorted(self.deleted, key=lambda element: order[element[0]]):
+            self.writer.delete(type, id, version)
+
+"""
+Tile range to the box of its pixels
+"""
+def pixel_box(tiles):
+    x0, y0, x1, y1 = tiles
+    return x0 * tile_size, y0 * tile_size, (x1 + 1) * tile_size - 1, (y1 + 1) * tile_size - 1
+
+def write_elements(writer, elements, version=1):
+    for element in elements:
+        if element[0] == 'node':
+            _, id, lat, lon = element
+            writer.node(id, lat, lon, version)
+        elif element[0] == 'way':
+            _, id, nodes, tags = element
+            writer.way(id, nodes, tags, version)
+        else:
+            _, id, members, tags = element
+            writer.relation(id, members, tags, version)
+
+def run(args, classes, tags, x0, y0, x1, y1, loadFunc):
+    options = {
+        'zoom': args.zoom,
+        'range': [x0, y0, x1, y1],
+        'classes': sorted([int(value), tags] for value, tags in classes.items()),
+        'tags': tags,
+        'simplify': args.simplify_tolerance_factor,
+    }
+    # Keep state files made before smoothing was added valid
+    if args.smoothing != 'none':
+        options['smoothing'] = args.smoothing
+    try:
+        state = VectorState(args.state, options)
+    except ValueError as e:
+        print('lakkavokka: %s' % e, file=sys.stderr)
+        return 1
+
+    with profiled(args.profile, args.cprofile), \
+         open_output(args.output) as out, OsmChangeWriter(out) as writer:
+        vectorizer = IncrementalVectorizer(state, args.zoom, classes, loadFunc, writer, args.simplify_tolerance_factor,
+                                           tags, args.concurrency, args.block, args.smoothing)
+        vectorizer.run(x0, y0, x1, y1)
+
+    # The state follows the output only if the output is complete
+    state.commit()
+
+    print('lakkavokka: %(changed_tiles)d changed tiles, %(created)d created, %(modified)d modified, '
+          '%(deleted)d deleted, %(unchanged)d unchanged features' % vectorizer.counts, file=sys.stderr)
@@ -0,0 +1,352 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import os
+import sys
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from functools import lru_cache
+
+import numpy as np
+import cv2 as cv
+from shapely.geometry import LineString
+
+from lakkavokka import make_parser, make_loader, smoothing_methods, smoothing
+from lakkavokka.bulk import BulkVectorizer, parse_bbox, parse_class, bbox_tiles, polygon_parts, source_classes, tile_values
+from lakkavokka.contours import tile_size, parse_color
+from lakkavokka.global_mercator import GlobalMercator
+from lakkavokka.writer import write_ring
+from lakkavokka.instrument import profile, profiled
+
+def get_args(argv=None):
+    usage = "usage: %prog index [options] --bbox <min_lon,min_lat,max_lon,max_lat> --class <color>:<tags> --output <index.sqlite>"
+    parser = make_parser(usage)
+
+    parser.add_option('--bbox', dest='bbox',
+                      type='str',
+                      help="Area to index: min_lon,min_lat,max_lon,max_lat")
+
+    parser.add_option('-c', '--class', dest='classes',
+                      default=[], action='append', type='str',
+                      help="Color to index, e.g. '#006400:natural=wood'. Palette index can be used instead of the color. "
+                           "Can be given several times")
+
+    parser.add_option('--block', dest='block',
+                      default=8, type='int',
+                      help="Size of the square block of tiles processed at once")
+
+    parser.add_option('--smoothing', dest='smoothing',
+                      default='savgol', type='choice', choices=smoothing_methods,
+                      help="Contour smoothing: savgol (default), spline, chaikin, average or none. "
+                           "The spline is about 100 times slower")
+
+    (options, args) = parser.parse_args(argv)
+
+    if not options.bbox or not options.classes or options.output == '-':
+        parser.print_usage()
+        print('--bbox, --class and --output options are required')
+        exit(-1)
+
+    return options
+
+schema = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE classes (value INTEGER PRIMARY KEY, color TEXT, tags TEXT);
+CREATE TABLE polygons (id INTEGER PRIMARY KEY, value INTEGER);
+CREATE TABLE rings (id INTEGER PRIMARY KEY, polygon INTEGER, ring INTEGER, clipped INTEGER, coords BLOB);
+CREATE INDEX polygons_value ON polygons (value);
+CREATE INDEX rings_polygon ON rings (polygon, ring);
+CREATE VIRTUAL TABLE ring_index USING rtree(id, min_x, max_x, min_y, max_y);
+'''
+
+"""
+Polygons of a tile range traced, smoothed and simplified once by `lakkavokka
+index`. Rings are kept in global raster pixel coordinates of the index zoom
+(pixel centers, y pointing down) as float64 (x, y) pairs, ring 0 of a polygon
+is its exterior. Bounding boxes of all rings are in the R-tree, so a lookup
+reads only the rings near the point even for polygons with thousands of
+holes. Rings touching the edge of the indexed range are marked as clipped,
+their outline there is the range edge rather than a class boundary. Every
+thread reads through its own connection.
+"""
+class VectorIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        meta = dict(self.connection().execute('SELECT key, value FROM meta'))
+        self.zoom = int(meta['zoom'])
+        self.range = tuple(json.loads(meta['range']))
+        self.smoothing = meta.get('smoothing')
+        self.simplify = float(meta.get('simplify', 'nan'))
+        self.classes = {value: (color, json.loads(tags))
+                        for value, color, tags in self.connection().execute('SELECT value, color, tags FROM classes')}
+        self.source_values = {}
+
+    def connection(self):
+        if not hasattr(self.local, 'db'):
+            uri = Path(os.path.abspath(self.path)).as_uri() + '?mode=ro'
+            self.local.db = sqlite3.connect(uri, uri=True)
+        return self.local.db
+
+    """
+    Indexed class of a pixel value of the given tile source, None if the
+    class is not indexed. The click source may differ from the one the index
+    was built from, e.g. PNG tiles and their mosaic with labels.
+    """
+    def class_value(self, source, value):
+        if source not in self.source_values:
+            self.source_values[source] = source_classes(
+                source, {parse_color(color): index_value for index_value, (color, _) in self.classes.items()})
+        return self.source_values[source].get(value)
+
+    """
+    Tags of an indexed class
+    """
+    def class_tags(self, value):
+        return self.classes[value][1]
+
+    def covers(self, x, y):
+        x0, y0, x1, y1 = self.range
+        return x0 <= x // tile_size <= x1 and y0 <= y // tile_size <= y1
+
+    """
+    Rings of polygons of the class with bounding boxes within the distance
+    from the point as (id, polygon, ring, clipped, coords) rows
+    """
+    def rings_near(self, x, y, value, distance=0):
+        rows = self.connection().execute(
+            'SELECT rings.id, polygon, ring, clipped, coords FROM ring_index JOIN rings ON rings.id = ring_index.id '
+            'JOIN polygons ON polygons.id = rings.polygon '
+            'WHERE min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ? AND polygons.value = ?',
+            (x + distance, x - distance, y + distance, y - distance, int(value)))
+        return [(id, polygon, ring, bool(clipped), np.frombuffer(coords, dtype=np.float64).reshape(-1, 2))
+                for id, polygon, ring, clipped, coords in rows]
+
+    """
+    Ring nearest to the point (x, y) of the polygon of the class containing
+    it as an (n, 2) array, None if the point is outside the indexed range, in
+    no polygon of the class or if the nearest ring is clipped. Smoothed
+    outlines of neighbouring polygons may overlap slightly, the polygon the
+    point is deepest in wins.
+    """
+    def nearest_ring(self, x, y, value):
+        if not self.covers(x, y):
+            return None
+
+        # Signed distances, positive inside the ring. Rings are shifted to the
+        # point so that float32 keeps sub-pixel precision.
+        distances = {}
+        def distance(id, coords):
+            if id not in distances:
+                distances[id] = cv.pointPolygonTest((coords - (x, y)).astype(np.float32).reshape(-1, 1, 2), (0, 0), True)
+            return distances[id]
+
+        # Only rings with the point in their bounding box can contain it
+        polygons = {}
+        for row in self.rings_near(x, y, value):
+            polygons.setdefault(row[1], []).append(row)
+
+        best = None
+        for polygon, rings in polygons.items():
+            exterior = [row for row in rings if row[2] == 0]
+            if not exterior:
+                continue
+            depth = min([distance(exterior[0][0], exterior[0][4])] +
+                        [-distance(row[0], row[4]) for row in rings if row[2] != 0])
+            if depth > 0 and (best is None or depth > best[0]):
+                best = (depth, polygon, rings)
+        if best is None:
+            return None
+
+        # The nearest ring is not farther than the nearest one seen so far
+        _, polygon, rings = best
+        nearest = min(rings, key=lambda row: abs(distance(row[0], row[4])))
+        for row in self.rings_near(x, y, value, abs(distance(nearest[0], nearest[4]))):
+            if row[1] == polygon and abs(distance(row[0], row[4])) < abs(distance(nearest[0], nearest[4])):
+                nearest = row
+
+        _, _, _, clipped, coords = nearest
+        return None if clipped else coords
+
+"""
+Indexes are opened once per process and reused between requests in
+`lakkavokka serve` mode, a rebuilt index is opened again
+"""
+@lru_cache(maxsize=None)
+def open_index(path, size, mtime_ns):
+    return VectorIndex(path)
+
+def openIndex(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return open_index(path, st.st_size, st.st_mtime_ns)
+
+"""
+Class value of the pixel at global pixel column and row (y pointing down),
+None if its tile is missing
+"""
+def pixel_value(zoom, col, row, loadFunc):
+    with profile.timer('tiles'):
+        tile = loadFunc(zoom, col // tile_size, row // tile_size)
+    if tile is None:
+        return None
+    col, row = col % tile_size, row % tile_size
+    return int(tile_values(tile[row:row + 1, col:col + 1])[0, 0])
+
+"""
+Write the ring of the indexed region of the clicked class nearest to the
+clicked point as a way, tagged with the tags of the class and the given
+ones. Only the clicked tile is loaded to find the class. Returns the next
+free id, or None if the index can't answer and the click has to be
+digitized from the raster: the index has another zoom, smoothing or
+simplification factor than the click, so its rings would differ in shape
+from the ones traced from the raster, or the click is outside the indexed
+range or its class or region is not indexed.
+"""
+def find_indexed_contour(index, zoom, lat, lon, writer, loadFunc, source, tags={}, id=-1, smoothing_method='savgol',
+                         simplify_tolerance_factor=2):
+    if index.zoom != zoom:
+        return None
+    if index.smoothing != smoothing_method or index.simplify != simplify_tolerance_factor:
+        profile.count('index_option_mismatches')
+        return None
+
+    proj = GlobalMercator()
+    world = tile_size * 2**zoom
+    px, py = proj.LatLonToPixelsArray(lat, lon, zoom)
+    x, y = float(px) - 0.5, world - float(py) - 0.5
+    if not index.covers(x, y):
+        profile.count('index_misses')
+        return None
+
+    value = index.class_value(source, pixel_value(zoom, int(np.floor(px)), int(np.floor(world - py)), loadFunc))
+    ring = None
+    if value is not None:
+        with profile.timer('index'):
+            ring = index.nearest_ring(x, y, value)
+    if ring is None:
+        profile.count('index_misses')
+        return None
+    profile.count('index_hits')
+
+    with profile.timer('output'):
+        lat, lon = proj.PixelsToLatLonArray(ring[:, 0] + 0.5, world - ring[:, 1] - 0.5, zoom)
+        _, id = write_ring(writer, id, np.stack([lat, lon], axis=1), dict(tags, **index.class_tags(value)))
+    profile.count('way_nodes', len(ring))
+    return id
+
+"""
+Traces polygons like `lakkavokka bulk` and stores them in the index instead
+of writing them. Every ring is smoothed and simplified on its own, as a click
+does with the contour it finds.
+"""
+class IndexBuilder(BulkVectorizer):
+    def __init__(self, db, zoom, classes, loadFunc, simplify_tolerance_factor=0, smoothing_method='spline',
+                 concurrency=1, block=8):
+        BulkVectorizer.__init__(self, zoom, classes, loadFunc, None, simplify_tolerance_factor,
+                                concurrency=concurrency, block=block, smoothing_method=smoothing_method)
+        self.db = db
+        self.edges = None
+
+    def run(self, x0, y0, x1, y1):
+        self.edges = (x0 * tile_size, y0 * tile_size, (x1 + 1) * tile_size - 1, (y1 + 1) * tile_size - 1)
+        BulkVectorizer.run(self, x0, y0, x1, y1)
+
+    def write(self, feature):
+        for polygon in polygon_parts(feature['geometry']):
+            if polygon.area == 0:
+                continue
+            rings = [ring.coords for ring in [polygon.exterior] + list(polygon.interiors)]
+            self.add(feature['value'], [(self.clipped(ring), self.outline(ring)) for ring in rings])
+            self.written += 1
+
+    def clipped(self, coords):
+        left, top, right, bottom = self.edges
+        (minx, miny), (maxx, maxy) = np.min(coords, axis=0), np.max(coords, axis=0)
+        return bool(minx <= left or miny <= top or maxx >= right or maxy >= bottom)
+
+    def outline(self, coords):
+        contour = np.asarray(coords, dtype=float)
+        with profile.timer('smoothing'):
+            contour = smoothing.backends[self.smoothing_method](contour, True)
+        if self.simplify_tolerance_factor:
+            with profile.timer('simplify'):
+                contour = np.asarray(LineString(contour).simplify(self.simplify_tolerance_factor).coords)
+        if not (contour[0] == contour[-1]).all():
+            contour = np.concatenate([contour, contour[:1]])
+        return contour
+
+    def add(self, value, rings):
+        polygon = self.db.execute('INSERT INTO polygons (value) VALUES (?)', (int(value),)).lastrowid
+        for i, (clipped, ring) in enumerate(rings):
+            id = self.db.execute('INSERT INTO rings (polygon, ring, clipped, coords) VALUES (?, ?, ?, ?)',
+                                 (polygon, i, int(clipped), np.ascontiguousarray(ring, dtype=np.float64).tobytes())).lastrowid
+            (minx, miny), (maxx, maxy) = ring.min(axis=0), ring.max(axis=0)
+            self.db.execute('INSERT INTO ring_index VALUES (?, ?, ?, ?, ?)',
+                            (id, float(minx), float(maxx), float(miny), float(maxy)))
+
+def main(argv=None):
+    args = get_args(argv)
+
+    # Class values as they are in the tiles, with the colors they were given as
+    specs = {}
+    for spec in args.classes:
+        value, tags = parse_class(spec)
+        specs[value] = (spec.partition(':')[0].strip(), tags)
+    specs = source_classes(args.source, specs)
+    classes = {value: tags for value, (_, tags) in specs.items()}
+    x0, y0, x1, y1 = bbox_tiles(parse_bbox(args.bbox), args.zoom)
+    loadFunc = make_loader(args)
+
+    print('lakkavokka: indexing %dx%d tiles' % (x1 - x0 + 1, y1 - y0 + 1), file=sys.stderr)
+
+    # Build a temporary file first so clicks never see a partial index
+    tmp = '%s.%d.tmp' % (args.output, os.getpid())
+    db = sqlite3.connect(tmp)
+    try:
+        db.executescript(schema)
+        db.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('zoom', str(args.zoom)),
+            ('range', json.dumps([x0, y0, x1, y1])),
+            ('source', args.source),
+            ('smoothing', args.smoothing),
+            ('simplify', str(args.simplify_tolerance_factor)),
+        ])
+        db.executemany('INSERT INTO classes VALUES (?, ?, ?)',
+                       [(int(value), color, json.dumps(tags)) for value, (color, tags) in specs.items()])
+
+        with profiled(args.profile, args.cprofile):
+            builder = IndexBuilder(db, args.zoom, classes, loadFunc, args.simplify_tolerance_factor,
+                                   args.smoothing, args.concurrency, args.block)
+            builder.run(x0, y0, x1, y1)
+
+        db.commit()
+        db.close()
+        os.replace(tmp, args.output)
+    except BaseException:
+        db.close()
+        os.unlink(tmp)
+        raise
+
+    print('lakkavokka: %d polygons' % builder.written, file=sys.stderr)
@@ -0,0 +1,139 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+"""
+Named timers and counters of the processing stages. Timers sum the wall time
+and the number of calls of every stage, counters sum amounts of processed
+data. Both can be updated from tile loading threads.
+"""
+class Profile(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.started = time.perf_counter()
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                seconds, calls = self.timers.get(name, (0, 0))
+                self.timers[name] = (seconds + elapsed, calls + 1)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        with self.lock:
+            return {
+                'seconds': time.perf_counter() - self.started,
+                'timers': {name: {'seconds': seconds, 'calls': calls}
+                           for name, (seconds, calls) in self.timers.items()},
+                'counters': dict(self.counters),
+            }
+
+    """
+    Return the report and start over. Worker processes use it to send the
+    numbers of every task to the main process.
+    """
+    def take(self):
+        report = self.report()
+        self.reset()
+        return report
+
+    """
+    Add timers and counters of a report taken in another process
+    """
+    def merge(self, report):
+        with self.lock:
+            for name, timer in report['timers'].items():
+                seconds, calls = self.timers.get(name, (0, 0))
+                self.timers[name] = (seconds + timer['seconds'], calls + timer['calls'])
+            for name, amount in report['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+"""
+Process-wide profile. It is reset by every profiled run, so in
+`lakkavokka serve` mode every click is reported separately.
+"""
+profile = Profile()
+
+def write_report(report, path):
+    if path == '-':
+        # Standard output is reserved for the data read by JOSM
+        json.dump(report, sys.stderr, indent=2, sort_keys=True)
+        print(file=sys.stderr)
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+"""
+Collect the profile of the enclosed run. The JSON report is written to
+report_path ('-' is standard error) and cProfile statistics are dumped to
+cprofile_path in pstats format.
+"""
+@contextmanager
+def profiled(report_path=None, cprofile_path=None):
+    if not report_path and not cprofile_path:
+        yield
+        return
+
+    # Imported here, so the tile cache does not depend on the profile
+    from lakkavokka.cache import tile_cache, patch_cache
+
+    profile.reset()
+
+    profiler = None
+    if cprofile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+
+        if report_path:
+            report = profile.report()
+            cache = tile_cache.stats()
+            report['tile_cache'] = {key: cache[key] for key in ('tiles', 'bytes', 'max_bytes')}
+            cache = patch_cache.stats()
+            report['patch_cache'] = {'entries': cache['tiles'], 'bytes': cache['bytes'], 'max_bytes': cache['max_bytes']}
+            write_report(report, report_path)
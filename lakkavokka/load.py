@@ -20,33 +20,337 @@
 # SOFTWARE.
 ################################################################################
 
+import io
+import os
+import re
 import sys
-import requests
-from os.path import join, exists
-from PIL import Image
+import threading
+from pathlib import Path
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, exists, getsize
 import numpy as np
 
+from lakkavokka.instrument import profile
+from lakkavokka.mosaic import MosaicSource
+
+
+"""
+2D array of palette indices keeping the palette of its tile as a (256, 3)
+RGB array. Views and slices keep the palette as well.
+"""
+class PaletteTile(np.ndarray):
+    def __array_finalize__(self, obj):
+        self.palette = getattr(obj, 'palette', None)
+
+"""
+Palette of a decoded tile, None for RGB tiles and mosaic labels
+"""
+def tile_palette(tile):
+    return getattr(tile, 'palette', None)
+
+"""
+Palette indices converted to RGB colors through the palette
+"""
+def expand_palette(indices, palette):
+    return palette[np.asarray(indices)]
+
+"""
+Raised when tiles of a source can not be compared by their class values
+"""
+class PaletteError(ValueError):
+    pass
+
+"""
+Checks that tiles of a source can be compared by their class values: they
+are all RGB, all palette tiles with the same palette or all mosaic labels.
+Commands matching classes over a whole area call it for every loaded tile.
+"""
+class PaletteCheck(object):
+    def __init__(self):
+        self.kind = None
+        self.palette = None
+        self.lock = threading.Lock()
+
+    def __call__(self, tile):
+        palette = tile_palette(tile)
+        kind = 'rgb' if tile.ndim == 3 else 'labels' if palette is None else 'palette'
+        with self.lock:
+            if self.kind is None:
+                self.kind, self.palette = kind, palette
+                return
+        if kind != self.kind:
+            raise PaletteError('Source mixes palette and RGB tiles, their classes can not be matched')
+        if kind == 'palette' and not np.array_equal(palette, self.palette):
+            raise PaletteError('Palette tiles of the source have different palettes, their classes can not '
+                               'be matched by palette index. Convert the tiles to RGB')
+
+"""
+Convert a tile image to an array. Palette images are returned as 2D arrays
+of palette indices (PaletteTile) without expanding them to RGB, all other
+images as (height, width, 3) RGB arrays.
+"""
+def decodeTile(pil_img):
+    if pil_img.mode == 'P':
+        tile = np.array(pil_img).view(PaletteTile)
+        colors = np.array(pil_img.getpalette() or [], dtype=np.uint8).reshape(-1, 3)[:256]
+        tile.palette = np.zeros((256, 3), dtype=np.uint8)
+        tile.palette[:len(colors)] = colors
+        return tile
+    if pil_img.mode != 'RGB':
+        pil_img = pil_img.convert('RGB')
+    return np.array(pil_img)
+
+
+"""
+Open a tile image from a path or from its content. PIL is imported on first
+use, memory mapped mosaics don't need it at all.
+"""
+def openImage(data):
+    from PIL import Image
+
+    if isinstance(data, bytes):
+        data = io.BytesIO(data)
+    return Image.open(data)
+
+
+def diskTilePath(zoom, x, y, base_path):
+    return base_path \
+            .replace('{zoom}', str(zoom)) \
+            .replace('{x}', str(x)) \
+            .replace('{y}', str(y))
+
+"""
+Modification time of a tile file of a local tree, None if it is missing.
+Cached tiles are checked against it, so a regenerated tree is read again.
+"""
+def diskTileStamp(zoom, x, y, base_path):
+    try:
+        return os.stat(diskTilePath(zoom, x, y, base_path)).st_mtime_ns
+    except OSError:
+        return None
 
 def loadFromDisk(zoom, x, y, base_path):
-    tile_file = base_path \
-                .replace('{zoom}', str(zoom)) \
-                .replace('{x}', str(x)) \
-                .replace('{y}', str(y))
+    tile_file = diskTilePath(zoom, x, y, base_path)
 
-    if not exists(tile_file):
+    # Some tile generators write empty files for empty tiles
+    if not exists(tile_file) or getsize(tile_file) == 0:
+        profile.count('tiles_missing')
         return None
 
-    pil_img = Image.open(tile_file)
-    return np.array(pil_img)
+    with profile.timer('decode'):
+        pil_img = openImage(tile_file)
+        return decodeTile(pil_img)
+
 
+"""
+HTTP session with a keep-alive connection pool large enough for the given
+concurrency. Failed requests and 429/5xx responses are retried with
+exponential backoff. Sessions are shared process-wide, so connections
+survive between requests in `lakkavokka serve` mode.
+"""
+@lru_cache(maxsize=None)
+def get_session(concurrency=8, retries=3, backoff=0.5):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 
-def downloadTile(zoom, x, y, base_url):
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(concurrency, 1), max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+"""
+Load a list of (zoom, x, y) tiles preserving the order. With concurrency > 1
+tiles are loaded by a thread pool, so downloads and PNG decoding overlap.
+"""
+def load_tiles(tiles, loadFunc, concurrency=1):
+    if concurrency <= 1 or len(tiles) <= 1:
+        return [loadFunc(*t) for t in tiles]
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(tiles))) as pool:
+        return list(pool.map(lambda t: loadFunc(*t), tiles))
+
+"""
+Download a tile. If a TileStore is given, the stored copy is revalidated with
+a conditional request and reused when the server replies 304 Not Modified.
+"""
+def downloadTile(zoom, x, y, base_url, store=None, session=None, timeout=None):
     tile_url = base_url \
                 .replace('{zoom}', str(zoom)) \
                 .replace('{x}', str(x)) \
                 .replace('{y}', str(y))
 
-    response = requests.get(tile_url, stream=True)
+    import requests
 
-    pil_img = Image.open(response.raw)
-    return np.array(pil_img)
+    headers = store.validators(tile_url) if store is not None else {}
+
+    with profile.timer('fetch'):
+        response = (session or requests).get(tile_url, headers=headers, timeout=timeout)
+
+    # 304 has no body either, check it before empty responses
+    if response.status_code == 304:
+        profile.count('tiles_not_modified')
+        content = store.read(tile_url)
+    elif response.status_code in (204, 404) or (response.ok and not response.content):
+        profile.count('tiles_missing')
+        return None
+    else:
+        response.raise_for_status()
+        content = response.content
+        profile.count('tiles_downloaded')
+        profile.count('bytes_downloaded', len(content))
+        if store is not None:
+            store.write(tile_url, content,
+                        response.headers.get('ETag'),
+                        response.headers.get('Last-Modified'))
+
+    with profile.timer('decode'):
+        pil_img = openImage(content)
+        return decodeTile(pil_img)
+
+
+"""
+Tiles stored in an MBTiles SQLite database. MBTiles rows are numbered in
+TMS notation, so y is flipped to keep the same (zoom, x, y) Google tile
+coordinates as other sources. Every thread reads through its own connection.
+"""
+class MBTilesSource(object):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        if not hasattr(self.local, 'db'):
+            import sqlite3
+            uri = Path(os.path.abspath(self.path)).as_uri() + '?mode=ro'
+            self.local.db = sqlite3.connect(uri, uri=True)
+        return self.local.db
+
+    def load(self, zoom, x, y):
+        row = self.connection().execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (zoom, x, (2**zoom - 1) - y)).fetchone()
+
+        if row is None:
+            profile.count('tiles_missing')
+            return None
+
+        with profile.timer('decode'):
+            return decodeTile(openImage(row[0]))
+
+
+"""
+Tiles stored in an uncompressed tar archive as {zoom}/{x}/{y}.<ext> members
+under any common prefix. Offsets of the members are indexed once and kept
+next to the archive in <archive>.index.npz, so tiles are read by seek without
+extracting or scanning the archive again.
+"""
+class TarSource(object):
+    member_re = re.compile(r'(?:^|/)(\d+)/(\d+)/(\d+)\.\w+$')
+
+    def __init__(self, path):
+        if path.endswith(('.gz', '.tgz', '.bz2', '.xz')):
+            raise IOError('Compressed archive %s can not be read by seek, '
+                          'decompress it first, e.g. with gunzip' % path)
+        self.path = path
+        self.keys, self.offsets, self.sizes = self.load_index()
+        self.fd = os.open(path, os.O_RDONLY)
+
+    @staticmethod
+    def key(zoom, x, y):
+        return (zoom << 58) | (x << 29) | y
+
+    def index_path(self):
+        return self.path + '.index.npz'
+
+    def load_index(self):
+        st = os.stat(self.path)
+        stat = np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+        try:
+            with np.load(self.index_path()) as index:
+                if np.array_equal(index['stat'], stat):
+                    return index['keys'], index['offsets'], index['sizes']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        keys, offsets, sizes = self.build_index()
+        try:
+            # Write to a temporary file first so concurrent readers never
+            # see a partially written index
+            tmp = '%s.%d.tmp' % (self.index_path(), os.getpid())
+            with open(tmp, 'wb') as f:
+                np.savez(f, keys=keys, offsets=offsets, sizes=sizes, stat=stat)
+            os.replace(tmp, self.index_path())
+        except OSError as e:
+            print('lakkavokka: can\'t save tar index: %s' % e, file=sys.stderr)
+        return keys, offsets, sizes
+
+    def build_index(self):
+        import tarfile
+
+        print('lakkavokka: indexing %s' % self.path, file=sys.stderr)
+        try:
+            tar = tarfile.open(self.path, 'r:')
+        except tarfile.ReadError as e:
+            raise IOError('%s is not an uncompressed tar archive: %s' % (self.path, e))
+
+        entries = {}
+        with tar:
+            for member in tar:
+                match = self.member_re.search(member.name)
+                if member.isfile() and match:
+                    zoom, x, y = map(int, match.groups())
+                    entries[self.key(zoom, x, y)] = (member.offset_data, member.size)
+
+        keys = np.array(sorted(entries), dtype=np.uint64)
+        offsets = np.array([entries[k][0] for k in keys.tolist()], dtype=np.int64)
+        sizes = np.array([entries[k][1] for k in keys.tolist()], dtype=np.int64)
+        return keys, offsets, sizes
+
+    def load(self, zoom, x, y):
+        key = self.key(zoom, x, y)
+        i = np.searchsorted(self.keys, np.uint64(key))
+        if i == len(self.keys) or self.keys[i] != key:
+            profile.count('tiles_missing')
+            return None
+
+        # pread doesn't move the shared file position, so threads don't interfere
+        content = os.pread(self.fd, int(self.sizes[i]), int(self.offsets[i]))
+
+        with profile.timer('decode'):
+            return decodeTile(openImage(content))
+
+
+"""
+Archive sources are opened once per process and reused between requests in
+`lakkavokka serve` mode. The file size and modification time are a part of
+the key, so a replaced archive is opened again.
+"""
+@lru_cache(maxsize=None)
+def open_archive(kind, path, size, mtime_ns):
+    if kind == 'mbtiles':
+        return MBTilesSource(path)
+    if kind == 'mosaic':
+        return MosaicSource(path)
+    return TarSource(path)
+
+
+"""
+Archive source of a --source value: an MBTiles file (mbtiles://path or
+*.mbtiles), a tar archive (tar://path or *.tar) or a mosaic made by
+`lakkavokka convert` (mosaic://path or *.mosaic). None for other sources.
+"""
+def openArchive(source):
+    for kind, suffixes in (('mbtiles', ('.mbtiles',)), ('tar', ('.tar', '.tar.gz', '.tgz')), ('mosaic', ('.mosaic',))):
+        scheme = kind + '://'
+        if source.startswith(scheme) or source.endswith(suffixes):
+            path = os.path.abspath(source[len(scheme):] if source.startswith(scheme) else source)
+            st = os.stat(path)
+            return open_archive(kind, path, st.st_size, st.st_mtime_ns)
+    return None
@@ -0,0 +1,93 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import os
+import json
+
+import numpy as np
+
+from lakkavokka.instrument import profile
+
+"""
+Raw label mosaic: a tile range of one zoom level converted to class labels.
+The file starts with a text line 'LKMOSAIC <header size>' and a JSON header
+padded with spaces to the header size, followed by the labels of every tile
+as a tile_size x tile_size block. Blocks go row by row of tiles from the top
+left tile. Label 0 marks missing tiles, label i stands for palette[i - 1],
+which is a packed RGB color or a palette index of the source tiles.
+"""
+MAGIC = b'LKMOSAIC'
+
+"""
+Header is padded to a multiple of the page size, so blocks are page aligned
+"""
+ALIGNMENT = 4096
+
+def write_header(f, header):
+    data = json.dumps(header, sort_keys=True).encode('utf-8')
+    size = len(MAGIC) + 12 + len(data) + 1
+    size = (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    f.write(b'%s %10d\n' % (MAGIC, size))
+    f.write(data)
+    f.write(b'\n'.ljust(size - len(MAGIC) - 12 - len(data), b' '))
+    return size
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        magic, size = f.readline().split()
+        if magic != MAGIC:
+            raise IOError('%s is not a lakkavokka mosaic' % path)
+        header = json.loads(f.read(int(size) - f.tell()))
+    header['offset'] = int(size)
+    return header
+
+"""
+Tiles of a mosaic file mapped into memory. Tiles are views of the mapped
+file, so loading a tile costs neither I/O nor decoding until its pixels are
+used, and the OS page cache keeps them between clicks.
+"""
+class MosaicSource(object):
+    def __init__(self, path):
+        self.path = path
+        self.header = header = read_header(path)
+        self.zoom = header['zoom']
+        self.x0, self.y0, self.x1, self.y1 = header['x0'], header['y0'], header['x1'], header['y1']
+        self.palette = header['palette']
+
+        tile_size = header['tile_size']
+        shape = (self.y1 - self.y0 + 1, self.x1 - self.x0 + 1, tile_size, tile_size)
+        self.blocks = np.memmap(path, dtype=header['dtype'], mode='r', offset=header['offset'], shape=shape)
+
+    def load(self, zoom, x, y):
+        if zoom != self.zoom or not (self.x0 <= x <= self.x1 and self.y0 <= y <= self.y1):
+            profile.count('tiles_missing')
+            return None
+        return self.blocks[y - self.y0, x - self.x0]
+
+    """
+    Label of a packed RGB color or a palette index of the source tiles
+    """
+    def label(self, value):
+        try:
+            return self.palette.index(value) + 1
+        except ValueError:
+            return None
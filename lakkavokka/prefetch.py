@@ -0,0 +1,271 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import os
+import sys
+import json
+import math
+import time
+import threading
+from optparse import OptionParser
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from lakkavokka import add_source_options
+from lakkavokka.bulk import parse_bbox, bbox_tiles, polygon_parts
+from lakkavokka.contours import tile_size
+from lakkavokka.global_mercator import GlobalMercator
+from lakkavokka.load import get_session
+from lakkavokka.instrument import profile, profiled
+
+def get_args(argv=None):
+    usage = "usage: %prog prefetch [options] --bbox <min_lon,min_lat,max_lon,max_lat> --output <directory>\n" \
+            "       %prog prefetch [options] --polygon <area.geojson> --output <directory>"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('-z', '--zoom', dest='zoom',
+                      default=16, type='int',
+                      help="Zoom level of the tiles to download")
+
+    add_source_options(parser)
+
+    parser.add_option('-o', '--output', dest='output',
+                      default=None, type='str', metavar='DIRECTORY',
+                      help="Directory to download tiles to, in the {zoom}/{x}/{y} layout of --source")
+
+    parser.add_option('--bbox', dest='bbox',
+                      type='str',
+                      help="Area to download: min_lon,min_lat,max_lon,max_lat")
+
+    parser.add_option('--polygon', dest='polygon',
+                      type='str',
+                      help="GeoJSON file with polygons of the area to download")
+
+    parser.add_option('--progress', dest='progress',
+                      default=5, type='float',
+                      help="Seconds between progress reports, 0 disables them")
+
+    (options, args) = parser.parse_args(argv)
+
+    if not (options.bbox or options.polygon) or not options.output:
+        parser.print_usage()
+        print('--bbox or --polygon and --output options are required')
+        exit(-1)
+
+    if not options.source.startswith(('http://', 'https://')):
+        parser.print_usage()
+        print('--source must be a tile server URL')
+        exit(-1)
+
+    return options
+
+"""
+Union of Polygon and MultiPolygon geometries of a GeoJSON file
+"""
+def read_geojson_area(f):
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+
+    def geometries(obj):
+        if obj['type'] == 'FeatureCollection':
+            for feature in obj['features']:
+                yield from geometries(feature)
+        elif obj['type'] == 'Feature':
+            if obj['geometry']:
+                yield from geometries(obj['geometry'])
+        elif obj['type'] in ('Polygon', 'MultiPolygon'):
+            yield shape(obj)
+
+    return unary_union(list(geometries(json.load(f))))
+
+"""
+Tiles of the bbox in Google (XYZ) notation, row by row
+"""
+def bbox_tile_list(bbox, zoom):
+    x0, y0, x1, y1 = bbox_tiles(bbox, zoom)
+    for y in range(y0, y1 + 1):
+        for x in range(x0, x1 + 1):
+            yield zoom, x, y
+
+"""
+Tiles touching the (lon, lat) area in Google (XYZ) notation, row by row. The
+area is projected to tile units, then every row of tiles is intersected with
+it. A connected part of the intersection covers every column between its
+left and right bounds, so the columns are taken from bounds of the parts.
+"""
+def area_tile_list(area, zoom):
+    from shapely.geometry import Polygon, MultiPolygon, box
+
+    proj = GlobalMercator()
+    tiles = 2**zoom
+
+    def to_tiles(coords):
+        coords = np.asarray(coords)
+        px, py = proj.LatLonToPixelsArray(coords[:, 1], coords[:, 0], zoom)
+        # Google tile rows grow southwards
+        return np.column_stack([px / tile_size, tiles - py / tile_size])
+
+    area = MultiPolygon([Polygon(to_tiles(polygon.exterior.coords),
+                                 [to_tiles(ring.coords) for ring in polygon.interiors])
+                         for polygon in polygon_parts(area)])
+    if area.is_empty:
+        return
+
+    min_x, min_y, max_x, max_y = area.bounds
+    for y in range(max(int(min_y), 0), min(int(max_y), tiles - 1) + 1):
+        row = area.intersection(box(0, y, tiles, y + 1))
+        columns = set()
+        for part in getattr(row, 'geoms', [row]):
+            if part.is_empty:
+                continue
+            left, _, right, _ = part.bounds
+            columns.update(range(max(int(left), 0), min(max(math.ceil(right) - 1, int(left)), tiles - 1) + 1))
+        for x in sorted(columns):
+            yield zoom, x, y
+
+"""
+Downloads tiles into a {zoom}/{x}/{y}.png tree readable by loadFromDisk.
+Tiles are written to temporary files first, so an interrupted run leaves
+only complete tiles and the next run skips them. Missing tiles are stored
+as empty files, they are skipped as well and loadFromDisk treats them as
+missing.
+"""
+class Prefetcher(object):
+    def __init__(self, base_url, output, session, timeout=None):
+        self.base_url = base_url
+        self.output = output
+        self.session = session
+        self.timeout = timeout
+
+    def path(self, zoom, x, y):
+        return os.path.join(self.output, str(zoom), str(x), '%d.png' % y)
+
+    def fetch(self, zoom, x, y):
+        import requests
+
+        tile_url = self.base_url \
+                    .replace('{zoom}', str(zoom)) \
+                    .replace('{x}', str(x)) \
+                    .replace('{y}', str(y))
+        try:
+            with profile.timer('fetch'):
+                response = self.session.get(tile_url, timeout=self.timeout)
+            if response.status_code in (204, 404):
+                content = b''
+            else:
+                response.raise_for_status()
+                content = response.content
+        except requests.RequestException as e:
+            profile.count('tiles_failed')
+            print('lakkavokka: can\'t download %s: %s' % (tile_url, e), file=sys.stderr)
+            return
+
+        self.write(self.path(zoom, x, y), content)
+        if content:
+            profile.count('tiles_downloaded')
+            profile.count('bytes_downloaded', len(content))
+        else:
+            profile.count('tiles_missing')
+
+    def write(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    """
+    Download the tiles not present yet. At most 2 * concurrency downloads
+    are queued at a time, so huge areas don't fill the memory with pending
+    tasks.
+    """
+    def run(self, tiles, concurrency=8, report=None):
+        pending = set()
+
+        def collect(done):
+            for future in done:
+                future.result()
+            if report is not None:
+                report()
+
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+            for zoom, x, y in tiles:
+                profile.count('tiles')
+                if os.path.exists(self.path(zoom, x, y)):
+                    profile.count('tiles_present')
+                    continue
+                if len(pending) >= 2 * max(concurrency, 1):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(pool.submit(self.fetch, zoom, x, y))
+            collect(wait(pending).done)
+
+"""
+Prints throughput at most once per interval
+"""
+class Progress(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.reported = self.started
+
+    def __call__(self, force=False):
+        now = time.perf_counter()
+        if not force and (self.interval <= 0 or now - self.reported < self.interval):
+            return
+        self.reported = now
+
+        counters = profile.report()['counters']
+        seconds = max(now - self.started, 1e-9)
+        downloaded = counters.get('tiles_downloaded', 0)
+        size = counters.get('bytes_downloaded', 0)
+        print('lakkavokka: %d tiles, %d downloaded (%.1f MB), %d present, %d missing, %d failed, '
+              '%.1f tiles/s, %.2f MB/s' % (
+                  counters.get('tiles', 0), downloaded, size / 1e6,
+                  counters.get('tiles_present', 0), counters.get('tiles_missing', 0),
+                  counters.get('tiles_failed', 0), downloaded / seconds, size / 1e6 / seconds),
+              file=sys.stderr)
+
+def main(argv=None):
+    args = get_args(argv)
+
+    if args.polygon:
+        with open(args.polygon, encoding='utf-8') as f:
+            tiles = area_tile_list(read_geojson_area(f), args.zoom)
+    else:
+        tiles = bbox_tile_list(parse_bbox(args.bbox), args.zoom)
+
+    session = get_session(args.concurrency, args.retries, args.backoff)
+    prefetcher = Prefetcher(args.source, args.output, session, args.timeout)
+
+    with profiled(args.profile, args.cprofile):
+        progress = Progress(args.progress)
+        prefetcher.run(tiles, args.concurrency, progress)
+        progress(force=True)
+        failed = profile.report()['counters'].get('tiles_failed', 0)
+
+    print('lakkavokka: use --source %s' % os.path.join(args.output, '{zoom}', '{x}', '{y}.png'), file=sys.stderr)
+    if failed:
+        print('lakkavokka: %d tiles failed, run the command again to retry them' % failed, file=sys.stderr)
+        return 1
+    return 0
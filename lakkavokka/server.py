@@ -0,0 +1,213 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import io
+import os
+import sys
+import json
+import tempfile
+import importlib
+import traceback
+import socketserver
+from contextlib import redirect_stdout, redirect_stderr
+from optparse import OptionParser
+
+import lakkavokka
+from lakkavokka.cache import tile_cache
+
+"""
+Default socket path. Keep in sync with bin/lakkavokka-client
+"""
+def default_socket():
+    return os.path.join(tempfile.gettempdir(), 'lakkavokka-%d.sock' % os.getuid())
+
+def get_args(argv=None):
+    usage = "usage: %prog serve [--socket <path>]\n" \
+            "       %prog serve --port <port> --source <source> [--source <source> ...] [--index <index> ...]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('--socket', dest='socket',
+                      default=default_socket(), type='str',
+                      help="Unix socket to listen on")
+
+    parser.add_option('--port', dest='port',
+                      default=None, type='int',
+                      help="Listen on localhost TCP port instead of the Unix socket")
+
+    parser.add_option('--source', dest='sources',
+                      default=[], action='append', metavar='SOURCE',
+                      help="Tile source clicks over TCP may use, can be repeated")
+
+    parser.add_option('--index', dest='indexes',
+                      default=[], action='append', metavar='INDEX',
+                      help="Index clicks over TCP may use, can be repeated")
+
+    (options, args) = parser.parse_args(argv)
+
+    if options.port is not None and not options.sources:
+        parser.error('--port needs the tile sources clicks may use, give them with --source')
+
+    return options
+
+"""
+Options of a click making the server write files
+"""
+def written_files(args):
+    options = []
+    if args.output != '-':
+        options.append('--output')
+    if args.profile not in (None, '-'):
+        options.append('--profile')
+    if args.cprofile:
+        options.append('--cprofile')
+    if args.cache_dir:
+        options.append('--cache-dir')
+    return options
+
+"""
+Options of a click reading tiles or an index other than the ones the server
+was started with
+"""
+def unlisted_inputs(args, sources, indexes):
+    options = []
+    if lakkavokka.source_path(args.source) not in sources:
+        options.append('--source %s' % args.source)
+    if args.index and os.path.abspath(args.index) not in indexes:
+        options.append('--index %s' % args.index)
+    return options
+
+"""
+Run a single click request the same way as the command line tool does in
+the client working directory. Returns exit status and captured stdout/stderr.
+Any local user can connect to a TCP port, so untrusted requests run in the
+server working directory, may not write files and may read only the sources
+and indexes the server was started with, given as source_path() and
+absolute paths.
+"""
+def handle_click(argv, cwd=None, trusted=True, sources=(), indexes=()):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    status = 0
+    saved_cwd = os.getcwd()
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            if cwd and trusted:
+                os.chdir(cwd)
+            args = lakkavokka.get_args(argv)
+            if not trusted and written_files(args):
+                print('lakkavokka: %s can not be used over TCP, use the Unix socket'
+                      % ', '.join(written_files(args)), file=sys.stderr)
+                raise SystemExit(2)
+            if not trusted and unlisted_inputs(args, sources, indexes):
+                print('lakkavokka: %s not given to lakkavokka serve, can not be used over TCP'
+                      % ', '.join(unlisted_inputs(args, sources, indexes)), file=sys.stderr)
+                raise SystemExit(2)
+            lakkavokka.run(args)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os.chdir(saved_cwd)
+    return status, stdout.getvalue(), stderr.getvalue()
+
+"""
+TCP server, any local user can connect to it. Clicks may read only the
+sources and indexes it was started with
+"""
+class LocalTCPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+    trusted = False
+    sources = indexes = ()
+
+"""
+Unix socket server, the socket is accessible to its owner only
+"""
+class LocalUnixServer(socketserver.UnixStreamServer):
+    trusted = True
+    sources = indexes = ()
+
+    def server_bind(self):
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+class ClickHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        status, out, err = handle_click(request['argv'], request.get('cwd'), self.server.trusted,
+                                        self.server.sources, self.server.indexes)
+
+        response = json.dumps({'status': status, 'stdout': out, 'stderr': err})
+        self.wfile.write(response.encode('utf-8'))
+
+        stats = tile_cache.stats()
+        print('lakkavokka: %s -> %d (tile cache: %d hits, %d misses, %d evictions, %.1f MB)' % (
+            ' '.join(request['argv']), status,
+            stats['hits'], stats['misses'], stats['evictions'], stats['bytes'] / 1024 / 1024), file=sys.stderr)
+
+"""
+Modules the package imports lazily, the server imports them upfront so the
+first click is as fast as the following ones
+"""
+preload = [
+    'lakkavokka.contours',
+    'lakkavokka.load',
+    'lakkavokka.global_mercator',
+    'lakkavokka.index',
+    'scipy.interpolate',
+    'requests',
+    'PIL.Image',
+]
+
+"""
+Requests are handled one at a time: JOSM sends clicks sequentially and the
+loaded modules are shared by all of them.
+"""
+def main(argv=None):
+    args = get_args(argv)
+
+    for module in preload:
+        importlib.import_module(module)
+
+    if args.port is not None:
+        server = LocalTCPServer(('127.0.0.1', args.port), ClickHandler)
+        server.sources = {lakkavokka.source_path(source) for source in args.sources}
+        server.indexes = {os.path.abspath(index) for index in args.indexes}
+        address = '127.0.0.1:%d' % args.port
+    else:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = LocalUnixServer(args.socket, ClickHandler)
+        address = args.socket
+
+    print('lakkavokka: listening on %s' % address, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.port is None and os.path.exists(args.socket):
+            os.unlink(args.socket)
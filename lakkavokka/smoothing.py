@@ -0,0 +1,123 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import numpy as np
+
+"""
+Smoothing backends for traced contours. Every backend takes an (n, 2) array of
+LineString coordinates and whether it is a closed ring, in which case the last
+vertex repeats the first one, and returns smoothed coordinates following the
+same convention. Closed rings are smoothed with wrap-around, ends of open
+lines stay in place.
+"""
+
+"""
+Parametric smoothing spline through the vertices (scipy.interpolate.splprep).
+Reference implementation, it is the slowest one on long contours.
+"""
+def spline(contour, closed, s=5):
+    # SciPy is imported only when the spline is used, it is slow to import
+    import scipy.interpolate as si
+
+    tck, u = si.splprep(contour.transpose(), s=s)
+    contour = np.array(si.splev(u, tck)).transpose()
+
+    #Preserve topolgy
+    if closed:
+        contour = np.concatenate([contour, [contour[0]]])
+    return contour
+
+"""
+Chaikin corner cutting: every segment is replaced by points at 1/4 and 3/4 of
+its length. Each iteration doubles the number of vertices.
+"""
+def chaikin(contour, closed, iterations=2):
+    for _ in range(iterations):
+        if closed:
+            start, end = contour[:-1], np.roll(contour[:-1], -1, axis=0)
+        else:
+            start, end = contour[:-1], contour[1:]
+
+        cut = np.empty((2 * len(start), 2))
+        cut[0::2] = 0.75 * start + 0.25 * end
+        cut[1::2] = 0.25 * start + 0.75 * end
+
+        if closed:
+            contour = np.concatenate([cut, cut[:1]])
+        else:
+            contour = np.concatenate([contour[:1], cut, contour[-1:]])
+    return contour
+
+"""
+Convolve coordinates with a symmetric kernel. Closed rings are padded with
+vertices from the other end of the ring, open lines are padded with point
+reflections of their ends, which keeps the ends in place.
+"""
+def convolve(contour, closed, kernel):
+    half = len(kernel) // 2
+    if closed:
+        ring = contour[:-1]
+        half = min(half, len(ring) - 1)
+        kernel = kernel[len(kernel) // 2 - half:len(kernel) // 2 + half + 1]
+        padded = np.concatenate([ring[-half:] if half else ring[:0], ring, ring[:half]])
+    else:
+        half = min(half, len(contour) - 1)
+        kernel = kernel[len(kernel) // 2 - half:len(kernel) // 2 + half + 1]
+        head = 2 * contour[0] - contour[half:0:-1]
+        tail = 2 * contour[-1] - contour[-2:-half - 2:-1]
+        padded = np.concatenate([head, contour, tail])
+
+    kernel = kernel / kernel.sum()
+    smoothed = np.stack([np.convolve(padded[:, i], kernel, mode='valid') for i in (0, 1)], axis=1)
+
+    if closed:
+        return np.concatenate([smoothed, smoothed[:1]])
+    return smoothed
+
+"""
+Moving average over the window of vertices
+"""
+def moving_average(contour, closed, window=7):
+    return convolve(contour, closed, np.ones(window))
+
+"""
+Savitzky-Golay filter: every vertex is replaced by the value of a polynomial
+of the given order fitted to the window of vertices around it by least
+squares. It removes pixel steps while keeping corners sharper than the
+moving average does.
+"""
+def savitzky_golay(contour, closed, window=9, order=2):
+    half = window // 2
+    vandermonde = np.vander(np.arange(-half, half + 1), order + 1, increasing=True)
+    kernel = np.linalg.pinv(vandermonde)[0]
+    return convolve(contour, closed, kernel)
+
+def none(contour, closed):
+    return contour
+
+backends = {
+    'spline': spline,
+    'chaikin': chaikin,
+    'average': moving_average,
+    'savgol': savitzky_golay,
+    'none': none,
+}
@@ -0,0 +1,356 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import numpy as np
+from shapely.geometry import LineString, Point
+from shapely.prepared import prep
+
+from lakkavokka import smoothing
+from lakkavokka.bulk import BulkVectorizer, NODATA, polygon_parts
+from lakkavokka.contours import tile_size
+from lakkavokka.writer import write_polygon_elements, write_node_ring
+from lakkavokka.instrument import profile
+
+"""
+Size in pixels of the grid cells features not written yet are looked up by
+"""
+cell_size = 64
+
+"""
+Pack integer pixel corner coordinates into single integers
+"""
+def corner_codes(points):
+    points = np.asarray(points, dtype=np.int64)
+    return (points[..., 0] << 32) | points[..., 1]
+
+"""
+Pixel corners where edges of the topology end: corners of three or more
+regions and corners of two regions touching diagonally. Pixels of other
+values than the classes form a single background region. values are the
+pixels of a block starting at (offset_x, offset_y) and pad tells which of its
+(top, bottom, left, right) sides are borders of the area, those are padded
+with background.
+"""
+def find_junctions(values, classes, offset_x, offset_y, pad):
+    regions = np.where(np.isin(values, list(classes)), values, NODATA)
+    regions = np.pad(regions, ((pad[0], pad[1]), (pad[2], pad[3])), constant_values=NODATA)
+
+    a, b, c, d = regions[:-1, :-1], regions[:-1, 1:], regions[1:, :-1], regions[1:, 1:]
+    distinct = 1 + (b != a) + ((c != a) & (c != b)) + ((d != a) & (d != b) & (d != c))
+    rows, cols = np.nonzero((distinct >= 3) | ((a == d) & (b == c) & (a != b)))
+
+    return corner_codes(np.stack([cols + 1 + offset_x - pad[2], rows + 1 + offset_y - pad[0]], axis=1))
+
+"""
+Points of a line of pixel corners at every pixel step, the last point
+included
+"""
+def pixel_steps(coords):
+    coords = np.asarray(coords, dtype=np.int64)
+    steps = coords[1:] - coords[:-1]
+    lengths = np.abs(steps).sum(axis=1)
+    segments = np.repeat(np.arange(len(steps)), lengths)
+    offsets = np.arange(len(segments)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.concatenate([coords[:-1][segments] + np.sign(steps)[segments] * offsets[:, None], coords[-1:]])
+
+"""
+Points of a closed ring of pixel corners at every pixel step, the closing
+point excluded
+"""
+def ring_steps(ring):
+    return pixel_steps(ring.coords)[:-1]
+
+"""
+Corners of an open edge given by pixel steps, collinear points dropped
+"""
+def edge_corners(points):
+    directions = points[1:] - points[:-1]
+    turns = np.flatnonzero(np.any(directions[1:] != directions[:-1], axis=1)) + 1
+    return points[np.concatenate([[0], turns, [len(points) - 1]])]
+
+"""
+Corners of a closed ring given by pixel steps, collinear points dropped
+"""
+def ring_corners(points):
+    incoming = points - np.roll(points, 1, axis=0)
+    outgoing = np.roll(points, -1, axis=0) - points
+    return points[np.any(incoming != outgoing, axis=1)]
+
+def corner_key(a, b):
+    return (int(a[0]), int(a[1]), int(b[0]), int(b[1]))
+
+"""
+Streams features like BulkVectorizer, but adjacent features share their
+boundaries. Regions are traced along pixel edges, so neighbours have exactly
+the same boundary, and their rings are split into edges at junctions, the
+corners where three regions meet. Every edge is simplified once and its
+nodes are written once, ways of both features on its sides refer to the
+same nodes.
+
+An edge is identified by its end corner and the first corner after it, the
+way it goes from the smaller end (closed edges start at their smallest
+corner). Edges whose other side belongs to a feature not written yet are
+kept until that feature is written. Features are written only when no
+unprocessed block can touch them, so the neighbours of a written feature
+are already traced and all junctions along its edges are known.
+"""
+class TopologyVectorizer(BulkVectorizer):
+    cracks = True
+
+    def __init__(self, zoom, classes, loadFunc, writer, simplify_tolerance_factor=0, tags={}, concurrency=1, block=8,
+                 smoothing_method='none'):
+        BulkVectorizer.__init__(self, zoom, classes, loadFunc, writer, simplify_tolerance_factor, tags,
+                                concurrency, block, smoothing_method)
+        self.junctions = np.empty(0, dtype=np.int64)
+        self.junction_nodes = {}
+        self.edges = {}
+        self.extent = None
+        self.cells = None
+
+    def run(self, x0, y0, x1, y1):
+        self.extent = (x0 * tile_size, y0 * tile_size, (x1 + 1) * tile_size, (y1 + 1) * tile_size)
+        BulkVectorizer.run(self, x0, y0, x1, y1)
+
+    def add_block(self, values, offset_x, offset_y, ids):
+        height, width = values.shape
+        left, top, right, bottom = self.extent
+        pad = [int(side) for side in (offset_y == top, offset_y + height == bottom, offset_x == left,
+                                      offset_x + width == right)]
+        with profile.timer('junctions'):
+            self.junctions = np.union1d(self.junctions,
+                                        find_junctions(values, self.classes, offset_x, offset_y, pad))
+
+        BulkVectorizer.add_block(self, values, offset_x, offset_y, ids)
+
+    def flush(self, block_right, row_top, row_bottom):
+        self.cells = None
+        BulkVectorizer.flush(self, block_right, row_top, row_bottom)
+
+        # Junctions above all features not written yet are not needed any more:
+        # new polygons reach processed rows only by merging with such features
+        top = min((feature['bounds'][1] for feature in self.features.values()), default=np.inf)
+        self.junctions = self.junctions[(self.junctions & 0xFFFFFFFF) >= top]
+        self.junction_nodes = {code: node for code, node in self.junction_nodes.items() if code & 0xFFFFFFFF >= top}
+
+    """
+    Features not written yet by cells of the grid their bounds cross
+    """
+    def cell_features(self):
+        if self.cells is None:
+            self.cells = {}
+            for feature in self.features.values():
+                if feature['geometry'] is None:
+                    continue
+                minx, miny, maxx, maxy = (int(v) // cell_size for v in feature['bounds'])
+                for y in range(miny, maxy + 1):
+                    for x in range(minx, maxx + 1):
+                        self.cells.setdefault((x, y), []).append(feature)
+        return self.cells
+
+    def write(self, feature):
+        polygons, edges = [], []
+        with profile.timer('topology'):
+            for polygon in polygon_parts(feature['geometry']):
+                exterior, exterior_edges = self.ring(polygon.exterior, feature)
+                if exterior is None:
+                    continue
+
+                interiors = []
+                for ring in polygon.interiors:
+                    interior, interior_edges = self.ring(ring, feature)
+                    if interior is not None:
+                        interiors.append(interior)
+                        edges.extend(interior_edges)
+                polygons.append((exterior, interiors))
+                edges.extend(exterior_edges)
+
+        if polygons:
+            with profile.timer('output'):
+                for edge in edges:
+                    self.write_edge(edge)
+                self.id = write_polygon_elements(self.writer, self.id, polygons, self.feature_tags(feature),
+                                                 write_node_ring)
+            self.written += 1
+
+    """
+    Closed list of node ids of the ring and the edges it is made of. The node
+    list is None if the ring collapses after simplification.
+    """
+    def ring(self, ring, feature):
+        points = ring_steps(ring)
+        codes = corner_codes(points)
+        found = np.minimum(np.searchsorted(self.junctions, codes), len(self.junctions) - 1)
+        junctions = np.flatnonzero(self.junctions[found] == codes) if len(self.junctions) else []
+
+        if not len(junctions):
+            edge, reverse = self.closed_edge(points, feature)
+            pieces = [(edge, reverse)]
+        else:
+            points = np.roll(points, -junctions[0], axis=0)
+            points = np.concatenate([points, points[:1]])
+            ends = list(junctions - junctions[0]) + [len(points) - 1]
+            pieces = [self.open_edge(points[start:end + 1], feature) for start, end in zip(ends[:-1], ends[1:])]
+
+        nodes = []
+        for edge, reverse in pieces:
+            ids = edge['ids'][::-1] if reverse else edge['ids']
+            nodes.extend(ids[1:] if nodes else ids)
+
+        edges = [edge for edge, _ in pieces]
+        if len(set(nodes)) < 3:
+            return None, edges
+        return nodes, edges
+
+    """
+    Edge between two junctions given by its pixel steps and whether it goes
+    the other way than the steps
+    """
+    def open_edge(self, points, feature):
+        corners = edge_corners(points)
+        forward, backward = corner_key(corners[0], corners[1]), corner_key(corners[-1], corners[-2])
+        reverse = backward < forward
+        if reverse:
+            corners = corners[::-1]
+
+        key = min(forward, backward)
+        if key in self.edges:
+            return self.edges.pop(key), reverse
+
+        coords = self.smooth_simplify(corners, False)
+        ends = corner_codes(coords[[0, -1]]).tolist()
+        ids = [self.junction_node(ends[0])] + self.new_ids(len(coords) - 2) + [self.junction_node(ends[1])]
+        return self.new_edge(key, coords, ids, points, feature), reverse
+
+    """
+    Ring without junctions given by its pixel steps, e.g. the boundary of an
+    island
+    """
+    def closed_edge(self, points, feature):
+        corners = ring_corners(points)
+        start = np.lexsort((corners[:, 1], corners[:, 0]))[0]
+        corners = np.roll(corners, -start, axis=0)
+        reverse = corner_key(corners[0], corners[-1]) < corner_key(corners[0], corners[1])
+        if reverse:
+            corners = np.concatenate([corners[:1], corners[:0:-1]])
+
+        key = corner_key(corners[0], corners[1])
+        if key in self.edges:
+            return self.edges.pop(key), reverse
+
+        coords = self.smooth_simplify(np.concatenate([corners, corners[:1]]), True)
+        if len(coords) < 4:
+            return self.new_edge(key, coords[:0], [], points, feature, True), reverse
+
+        ids = self.new_ids(len(coords) - 1)
+        return self.new_edge(key, coords, ids + ids[:1], points, feature, True), reverse
+
+    def new_edge(self, key, coords, ids, points, feature, closed=False):
+        edge = {'ids': ids, 'coords': coords, 'closed': closed, 'written': False}
+        if self.shared(points, feature):
+            self.edges[key] = edge
+        return edge
+
+    """
+    Smooth and simplify the line of corners of an edge going from the
+    smaller end. Smoothing works on pixel steps like it does on contours of
+    clicks, ends of open edges stay at their junctions.
+    """
+    def smooth_simplify(self, corners, closed):
+        coords = corners
+        if self.smoothing_method != 'none':
+            steps = pixel_steps(corners)
+            if len(steps) > 3:
+                with profile.timer('smoothing'):
+                    coords = smoothing.backends[self.smoothing_method](steps.astype(np.float64), closed)
+                if not closed:
+                    coords[0], coords[-1] = steps[0], steps[-1]
+
+        if self.simplify_tolerance_factor:
+            with profile.timer('simplify'):
+                coords = np.asarray(LineString(coords).simplify(self.simplify_tolerance_factor).coords)
+        return coords
+
+    def new_ids(self, count):
+        ids = list(range(self.id, self.id - count, -1))
+        self.id -= count
+        return ids
+
+    def junction_node(self, code):
+        if code not in self.junction_nodes:
+            self.junction_nodes[code] = [self.id, False]
+            self.id -= 1
+        return self.junction_nodes[code][0]
+
+    """
+    Whether the pixel across the first step of the edge belongs to another
+    feature which is not written yet
+    """
+    def shared(self, points, feature):
+        (x0, y0), (x1, y1) = points[0], points[1]
+        if y0 == y1:
+            pixels = [(min(x0, x1) + 0.5, y0 - 0.5), (min(x0, x1) + 0.5, y0 + 0.5)]
+        else:
+            pixels = [(x0 - 0.5, min(y0, y1) + 0.5), (x0 + 0.5, min(y0, y1) + 0.5)]
+
+        for x, y in pixels:
+            for other in self.cell_features().get((int(x) // cell_size, int(y) // cell_size), []):
+                minx, miny, maxx, maxy = other['bounds']
+                if other is not feature and minx < x < maxx and miny < y < maxy:
+                    if 'prepared' not in other:
+                        other['prepared'] = prep(other['geometry'])
+                    if other['prepared'].contains(Point(x, y)):
+                        return True
+        return False
+
+    """
+    Write nodes of the edge unless they are written already
+    """
+    def write_edge(self, edge):
+        if edge['written']:
+            return
+        edge['written'] = True
+
+        latlon = self.to_latlon(edge['coords'])
+        ids = edge['ids']
+        if edge['closed']:
+            nodes = range(len(ids) - 1)
+        else:
+            nodes = range(1, len(ids) - 1)
+            for i in (0, -1):
+                junction = self.junction_nodes[int(corner_codes(edge['coords'][i]))]
+                if not junction[1]:
+                    junction[1] = True
+                    self.writer.node(ids[i], *latlon[i])
+
+        for i in nodes:
+            self.writer.node(ids[i], *latlon[i])
+
+    """
+    Convert global raster pixel corners (y pointing down) to an array of
+    (lat, lon)
+    """
+    def to_latlon(self, coords):
+        coords = np.asarray(coords, dtype=np.float64)
+        px = coords[:, 0]
+        py = tile_size * 2**self.zoom - coords[:, 1]
+        lat, lon = self.proj.PixelsToLatLonArray(px, py, self.zoom)
+        return np.stack([lat, lon], axis=1)
@@ -0,0 +1,261 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import json
+
+# xml.sax.saxutils drags in urllib.request and costs more than the rest of
+# the package to import
+xml_entities = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;',
+                              '"': '&quot;'})
+
+"""
+Escape a value for a double-quoted XML attribute
+"""
+def quote(value):
+    return '"%s"' % str(value).translate(xml_entities)
+
+"""
+Write a closed ring of (lat, lon) as nodes and a way. Returns the way id and
+the next free id.
+"""
+def write_ring(writer, id, ring, tags):
+    nodes = list(range(id, id - len(ring) + 1, -1))
+    for node_id, (lat, lon) in zip(nodes, ring[:-1]):
+        writer.node(node_id, lat, lon)
+    id -= len(nodes)
+
+    writer.way(id, nodes + nodes[:1], tags)
+    return id, id - 1
+
+"""
+Write a closed ring of ids of already written nodes as a way. Returns the way
+id and the next free id.
+"""
+def write_node_ring(writer, id, nodes, tags):
+    writer.way(id, nodes, tags)
+    return id, id - 1
+
+"""
+Write polygons given as a list of (exterior, interiors) closed (lat, lon)
+rings using nodes, ways and relations. A single polygon without holes
+becomes a closed way, anything else a multipolygon relation. Rings are
+written by ring_writer, write_node_ring takes rings of node ids instead.
+Returns the next free id.
+"""
+def write_polygon_elements(writer, id, polygons, tags, ring_writer=write_ring):
+    if len(polygons) == 1 and not polygons[0][1]:
+        _, id = ring_writer(writer, id, polygons[0][0], tags)
+        return id
+
+    members = []
+    for exterior, interiors in polygons:
+        way_id, id = ring_writer(writer, id, exterior, {})
+        members.append(('way', way_id, 'outer'))
+        for interior in interiors:
+            way_id, id = ring_writer(writer, id, interior, {})
+            members.append(('way', way_id, 'inner'))
+
+    writer.relation(id, members, dict({'type': 'multipolygon'}, **tags))
+    return id - 1
+
+"""
+Writes OSM XML elements to a stream as soon as they are produced
+"""
+class OsmWriter(object):
+    def __init__(self, out):
+        self.out = out
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # Keep partial output of a failed run unterminated, so it can't be
+        # taken for a complete one, and say why it ends
+        if exc_type is None:
+            self.close()
+        else:
+            self.out.write('<!-- lakkavokka: incomplete output, the run failed -->\n')
+            self.out.flush()
+
+    def start(self):
+        self.out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.out.write('<osm version="0.6" generator="lakkavokka">\n')
+
+    def node(self, id, lat, lon, version=1):
+        self.out.write(' <node id="%d" lat="%r" lon="%r" version="%d"/>\n' % (id, float(lat), float(lon), version))
+
+    def way(self, id, nodes, tags, version=1):
+        lines = [' <way id="%d" version="%d">\n' % (id, version)]
+        for k, v in tags.items():
+            lines.append('  <tag k=%s v=%s/>\n' % (quote(k), quote(v)))
+        for ref in nodes:
+            lines.append('  <nd ref="%d"/>\n' % ref)
+        lines.append(' </way>\n')
+        self.out.write(''.join(lines))
+
+    def relation(self, id, members, tags, version=1):
+        lines = [' <relation id="%d" version="%d">\n' % (id, version)]
+        for k, v in tags.items():
+            lines.append('  <tag k=%s v=%s/>\n' % (quote(k), quote(v)))
+        for type, ref, role in members:
+            lines.append('  <member type="%s" ref="%d" role=%s/>\n' % (type, ref, quote(role)))
+        lines.append(' </relation>\n')
+        self.out.write(''.join(lines))
+
+    def polygon(self, id, polygons, tags):
+        return write_polygon_elements(self, id, polygons, tags)
+
+    def close(self):
+        self.out.write('</osm>\n')
+        self.out.flush()
+
+"""
+Writes ways as GeoJSON features: closed ways as Polygons and others as
+LineStrings, with tags as properties. Nodes are written right before the
+way using them and are not shared with other ways, so node coordinates are
+kept only until their way is written.
+"""
+class GeoJsonWriter(object):
+    def __init__(self, out):
+        self.out = out
+        self.nodes = {}
+        self.features = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # Keep partial output of a failed run unterminated
+        if exc_type is None:
+            self.close()
+
+    def start(self):
+        self.out.write('{"type": "FeatureCollection", "features": [\n')
+
+    def node(self, id, lat, lon):
+        self.nodes[id] = [float(lon), float(lat)]
+
+    def way(self, id, nodes, tags):
+        coords = [self.nodes[ref] for ref in nodes]
+        for ref in nodes:
+            self.nodes.pop(ref, None)
+        if len(nodes) > 3 and nodes[0] == nodes[-1]:
+            geometry = {'type': 'Polygon', 'coordinates': [coords]}
+        else:
+            geometry = {'type': 'LineString', 'coordinates': coords}
+
+        self.feature(id, geometry, tags)
+
+    def polygon(self, id, polygons, tags):
+        rings = [[[[float(lon), float(lat)] for lat, lon in ring] for ring in [exterior] + list(interiors)]
+                 for exterior, interiors in polygons]
+        if len(rings) == 1:
+            geometry = {'type': 'Polygon', 'coordinates': rings[0]}
+        else:
+            geometry = {'type': 'MultiPolygon', 'coordinates': rings}
+
+        self.feature(id, geometry, tags)
+        return id - 1
+
+    def feature(self, id, geometry, tags):
+        feature = {'type': 'Feature', 'id': id, 'properties': tags, 'geometry': geometry}
+
+        if self.features:
+            self.out.write(',\n')
+        self.out.write(json.dumps(feature))
+        self.features += 1
+
+    def close(self):
+        self.out.write('\n]}\n')
+        self.out.flush()
+
+"""
+Keeps written elements in memory, so they can be renumbered and replayed
+into another writer later, e.g. to merge results of worker processes.
+"""
+class RecordingWriter(object):
+    def __init__(self):
+        self.elements = []
+
+    def node(self, id, lat, lon):
+        self.elements.append(('node', id, float(lat), float(lon)))
+
+    def way(self, id, nodes, tags):
+        self.elements.append(('way', id, list(nodes), tags))
+
+    def relation(self, id, members, tags):
+        self.elements.append(('relation', id, list(members), tags))
+
+    def polygon(self, id, polygons, tags):
+        return write_polygon_elements(self, id, polygons, tags)
+
+    """
+    Write recorded elements with all ids shifted by the given value
+    """
+    def replay(self, writer, shift=0):
+        for element in self.elements:
+            if element[0] == 'node':
+                _, id, lat, lon = element
+                writer.node(id + shift, lat, lon)
+            elif element[0] == 'way':
+                _, id, nodes, tags = element
+                writer.way(id + shift, [ref + shift for ref in nodes], tags)
+            else:
+                _, id, members, tags = element
+                writer.relation(id + shift, [(type, ref + shift, role) for type, ref, role in members], tags)
+
+"""
+Writes an osmChange document. Elements go to the section of the last
+action() call, sections are opened and closed as the action changes, so
+elements should be grouped by action. Deleted elements are written by id and
+version only.
+"""
+class OsmChangeWriter(OsmWriter):
+    def start(self):
+        self.section = None
+        self.out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.out.write('<osmChange version="0.6" generator="lakkavokka">\n')
+
+    def action(self, name):
+        if name == self.section:
+            return
+        if self.section is not None:
+            self.out.write('</%s>\n' % self.section)
+        self.out.write('<%s>\n' % name)
+        self.section = name
+
+    def delete(self, type, id, version=1):
+        self.action('delete')
+        self.out.write(' <%s id="%d" version="%d"/>\n' % (type, id, version))
+
+    def close(self):
+        if self.section is not None:
+            self.out.write('</%s>\n' % self.section)
+        self.out.write('</osmChange>\n')
+        self.out.flush()
+
+writers = {
+    'osm': OsmWriter,
+    'geojson': GeoJsonWriter,
+}
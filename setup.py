@@ -14,15 +14,13 @@ setup(
     author_email='mr.miroff@gmail.com',
     license='MIT',
     packages=['lakkavokka'],
-    scripts=['bin/lakkavokka'],
+    scripts=['bin/lakkavokka', 'bin/lakkavokka-client'],
     python_requires=">=3.8",
     install_requires=[
         'shapely',
         'opencv-python',
         'scipy',
-        'pyproj',
         'numpy',
-        'beautifulsoup4',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -0,0 +1,88 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+"""
+Bulk vectorization: features don't depend on the block size the area is
+processed in.
+"""
+
+import unittest
+
+import numpy as np
+import cv2 as cv
+
+from lakkavokka.contours import tile_size
+from lakkavokka.incremental import FeatureCollector
+
+# Pixel centers outline of this region pinches at the end of the one pixel
+# high bridge, the region is traced as one polygon with two parts
+PINCH = """
+...........##
+...........##
+..........###
+..........###
+.........####
+.......######
+...##########
+######....###
+#####......##
+####........#
+####.........
+##...........
+"""
+
+"""
+Loader of 4x4 tiles of random blobs of classes 1 and 2 with single pixels
+of class 1 touching them diagonally, and PINCH regions crossed by the seams
+of blocks of every size
+"""
+def blobs_loader():
+    rng = np.random.default_rng(1)
+    noise = cv.GaussianBlur(rng.random((4 * tile_size, 4 * tile_size)), (0, 0), 6)
+    image = np.where(noise > 0.52, 1, np.where(noise < 0.48, 2, 0)).astype(np.uint8)
+    image[rng.random(image.shape) > 0.999] = 1
+
+    pinch = np.array([[c == '#' for c in line] for line in PINCH.split()], dtype=np.uint8)
+    height, width = pinch.shape
+    for x, y in ((tile_size - 2, tile_size + 100), (3 * tile_size - 2, 2 * tile_size + 100),
+                 (tile_size + 100, 2 * tile_size - 3)):
+        image[y - 1:y + height + 1, x - 1:x + width + 1] = 0
+        image[y:y + height, x:x + width] = pinch
+
+    def load(zoom, x, y):
+        return image[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+    return load
+
+class BlockTest(unittest.TestCase):
+    def features(self, block):
+        collector = FeatureCollector(16, {1: {}, 2: {}}, blobs_loader(), block=block)
+        collector.run(0, 0, 3, 3)
+        return sorted((int(feature['value']), feature['wkb']) for feature in collector.collected)
+
+    def test_block_size(self):
+        features = self.features(4)
+        self.assertGreater(len(features), 10)
+        for block in (1, 2, 3):
+            self.assertEqual(self.features(block), features, 'block %d' % block)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+"""
+Tile downloads against a local HTTP server: missing tiles, retries of failed
+and timed out requests, revalidation of tiles stored with --cache-dir and
+concurrent loading of a patch.
+"""
+
+import io
+import time
+import tempfile
+import threading
+import unittest
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+from PIL import Image
+
+from lakkavokka import get_args, make_loader
+from lakkavokka.load import downloadTile, get_session
+from lakkavokka.contours import load_range, tile_size
+from lakkavokka.cache import TileStore
+from lakkavokka.instrument import profile
+
+def png(color, size=4):
+    out = io.BytesIO()
+    Image.new('RGB', (size, size), color).save(out, 'PNG')
+    return out.getvalue()
+
+"""
+Tile server with a fixed set of responses per path. A path maps to a list of
+(status, headers, body) or (status, headers, body, delay) replies, the last
+one is repeated. Replies with an ETag or Last-Modified header answer
+matching conditional requests with 304. The largest number of requests
+served at once is kept in 'overlap'.
+"""
+class TileHandler(BaseHTTPRequestHandler):
+    def __init__(self, server_state, *args, **kwargs):
+        self.state = server_state
+        BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+    def do_GET(self):
+        with self.state['lock']:
+            self.state['requests'].append((self.path, dict(self.headers)))
+            replies = self.state['replies'].get(self.path, [(404, {}, b'')])
+            served = self.state['served'].get(self.path, 0)
+            self.state['served'][self.path] = served + 1
+            self.state['active'] += 1
+            self.state['overlap'] = max(self.state['overlap'], self.state['active'])
+        try:
+            self.reply(*replies[min(served, len(replies) - 1)])
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting
+            pass
+        finally:
+            with self.state['lock']:
+                self.state['active'] -= 1
+
+    def reply(self, status, headers, body, delay=0):
+        time.sleep(delay)
+
+        if status == 200 and (
+                ('ETag' in headers and self.headers.get('If-None-Match') == headers['ETag']) or
+                ('Last-Modified' in headers and self.headers.get('If-Modified-Since') == headers['Last-Modified'])):
+            status, body = 304, b''
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status not in (204, 304):
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status not in (204, 304):
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.state = {'lock': threading.Lock(), 'replies': {}, 'served': {}, 'requests': [],
+                      'active': 0, 'overlap': 0}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(TileHandler, self.state))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/{zoom}/{x}/{y}.png' % self.server.server_address[1]
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.store = TileStore(self.cache_dir.name)
+        self.session = get_session(1, 2, 0)
+        profile.reset()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_dir.cleanup()
+
+    def download(self, store=None):
+        return downloadTile(16, 1, 2, self.url, store, self.session, timeout=5)
+
+    def reply(self, *replies):
+        self.state['replies']['/16/1/2.png'] = list(replies)
+
+    def headers_sent(self):
+        return [headers for path, headers in self.state['requests']]
+
+    def test_missing_tiles(self):
+        for status in (404, 204):
+            self.reply((status, {}, b''))
+            self.assertIsNone(self.download(self.store))
+        self.reply((200, {}, b''))
+        self.assertIsNone(self.download(self.store))
+
+        self.assertEqual(profile.report()['counters']['tiles_missing'], 3)
+        self.assertEqual(self.store.validators(self.url.format(zoom=16, x=1, y=2)), {})
+
+    def test_retries(self):
+        self.reply((503, {}, b''), (503, {}, b''), (200, {}, png((0, 100, 0))))
+        tile = self.download()
+        self.assertEqual(tile.shape, (4, 4, 3))
+        self.assertTrue((tile == (0, 100, 0)).all())
+        self.assertEqual(len(self.state['requests']), 3)
+
+    def test_retries_exhausted(self):
+        self.reply((503, {}, b''))
+        with self.assertRaises(requests.exceptions.RequestException):
+            self.download()
+        self.assertEqual(len(self.state['requests']), 3)
+
+    def test_revalidation_with_etag(self):
+        self.reply((200, {'ETag': '"v1"'}, png((0, 100, 0))))
+        first = self.download(self.store)
+        second = self.download(self.store)
+
+        self.assertTrue((first == second).all())
+        self.assertNotIn('If-None-Match', self.headers_sent()[0])
+        self.assertEqual(self.headers_sent()[1]['If-None-Match'], '"v1"')
+        counters = profile.report()['counters']
+        self.assertEqual(counters['tiles_downloaded'], 1)
+        self.assertEqual(counters['tiles_not_modified'], 1)
+
+    def test_revalidation_with_last_modified(self):
+        modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        self.reply((200, {'Last-Modified': modified}, png((0, 0, 0))))
+        self.download(self.store)
+        self.download(self.store)
+
+        self.assertEqual(self.headers_sent()[1]['If-Modified-Since'], modified)
+        self.assertEqual(profile.report()['counters']['tiles_not_modified'], 1)
+
+    def test_changed_tile_replaces_stored_copy(self):
+        self.reply((200, {'ETag': '"v1"'}, png((0, 100, 0))),
+                   (200, {'ETag': '"v2"'}, png((200, 0, 0))))
+        self.download(self.store)
+        changed = self.download(self.store)
+        stored = self.download(self.store)
+
+        self.assertTrue((changed == (200, 0, 0)).all())
+        self.assertTrue((stored == (200, 0, 0)).all())
+        self.assertEqual(self.headers_sent()[2]['If-None-Match'], '"v2"')
+        self.assertEqual(profile.report()['counters']['tiles_not_modified'], 1)
+
+    def test_timeout_retries(self):
+        self.reply((200, {}, png((0, 100, 0)), 2), (200, {}, png((0, 100, 0))))
+        start = time.perf_counter()
+        tile = downloadTile(16, 1, 2, self.url, None, self.session, timeout=0.2)
+        self.assertLess(time.perf_counter() - start, 1.5)
+        self.assertTrue((tile == (0, 100, 0)).all())
+        self.assertEqual(self.state['served']['/16/1/2.png'], 2)
+
+    def test_timeout_retries_exhausted(self):
+        self.reply((200, {}, png((0, 100, 0)), 1))
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            downloadTile(16, 1, 2, self.url, None, self.session, timeout=0.2)
+        self.assertEqual(self.state['served']['/16/1/2.png'], 3)
+
+    def test_concurrent_patch(self):
+        colors = {}
+        for y in range(10, 13):
+            for x in range(20, 23):
+                colors[(x, y)] = (x, y, 0)
+                self.state['replies']['/16/%d/%d.png' % (x, y)] = [(200, {}, png(colors[(x, y)], tile_size), 0.2)]
+
+        # Loader of a click, its thread pool and connection pool follow --concurrency
+        concurrency = 3
+        args = get_args(['--lat', '52', '--lon', '57', '--source', self.url, '--concurrency', str(concurrency),
+                         '--timeout', '5', '--cache-size', '0'])
+        start = time.perf_counter()
+        image = load_range(16, 20, 10, 22, 12, make_loader(args), args.concurrency)
+
+        # Nine tiles of 0.2s in three rounds of three
+        self.assertLess(time.perf_counter() - start, 9 * 0.2)
+        self.assertEqual(self.state['overlap'], concurrency)
+        self.assertEqual(image.shape, (3 * tile_size, 3 * tile_size, 3))
+        for (x, y), color in colors.items():
+            row, col = (y - 10) * tile_size, (x - 20) * tile_size
+            self.assertTrue((image[row:row + tile_size, col:col + tile_size] == color).all())
+
+if __name__ == '__main__':
+    unittest.main()
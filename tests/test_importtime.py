@@ -0,0 +1,120 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+"""
+Import time budget of the command line. JOSM starts a new process for every
+click, so everything imported at the top of the package is paid on each of
+them. Every case runs under python -X importtime in a fresh interpreter and
+checks the modules left in sys.modules and the import time of lakkavokka.
+"""
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+import subprocess
+
+import numpy as np
+from PIL import Image
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+"""
+Cumulative import time of the top-level lakkavokka imports in ms, the best
+of this many runs is taken
+"""
+budget_ms = 50.0
+repeat = 3
+
+heavy = ('numpy', 'cv2', 'scipy', 'shapely', 'PIL', 'requests', 'pyproj')
+
+usage_code = """
+import lakkavokka
+try:
+    lakkavokka.get_args(['--help'])
+except SystemExit:
+    pass
+"""
+
+click_code = """
+import lakkavokka
+lakkavokka.main(%r)
+"""
+
+"""
+Run code under -X importtime in a fresh interpreter. Returns the import time
+of lakkavokka in ms and top-level names of the modules loaded by the end.
+Only top-level entries of the import tree are summed, nested lakkavokka
+modules are already in the cumulative time of their importer.
+"""
+def import_time(code):
+    code += '\nimport sys, json\nprint(json.dumps(sorted(set(name.split(".")[0] for name in sys.modules))))\n'
+    env = dict(os.environ, PYTHONPATH=root)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    total = 0
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if level == 0 and (name == 'lakkavokka' or name.startswith('lakkavokka.')):
+            total += int(cumulative)
+    return total / 1000.0, set(json.loads(process.stdout.splitlines()[-1]))
+
+class ImportTimeTest(unittest.TestCase):
+    def check(self, code, forbidden, budget=True):
+        results = [import_time(code) for _ in range(repeat)]
+        elapsed, modules = min(results, key=lambda result: result[0])
+        self.assertEqual(sorted(modules.intersection(forbidden)), [])
+        if budget:
+            self.assertLessEqual(elapsed, budget_ms)
+
+    def test_import(self):
+        self.check('import lakkavokka', heavy)
+
+    def test_usage(self):
+        self.check(usage_code, heavy)
+
+    def test_click_without_spline(self):
+        # Clicks on local tiles need numpy, cv2, shapely and PIL, but neither
+        # the HTTP stack nor scipy unless the spline smoothing is asked for
+        with tempfile.TemporaryDirectory() as tiles:
+            for x in range(43304, 43307):
+                for y in range(21545, 21548):
+                    os.makedirs(os.path.join(tiles, '16', str(x)), exist_ok=True)
+                    image = np.zeros((256, 256, 3), dtype=np.uint8)
+                    image[64:192, 64:192] = (0, 100, 0)
+                    Image.fromarray(image).save(os.path.join(tiles, '16', str(x), '%d.png' % y))
+
+            argv = ['--lat', '52.3410', '--lon', '57.8839', '--zoom', '16', '--smoothing', 'savgol',
+                    '--source', os.path.join(tiles, '{zoom}', '{x}', '{y}.png'),
+                    '--output', os.path.join(tiles, 'out.osm')]
+            self.check(click_code % argv, ('scipy', 'requests', 'pyproj'), budget=False)
+            with open(os.path.join(tiles, 'out.osm')) as f:
+                self.assertIn('<way', f.read())
+
+if __name__ == '__main__':
+    unittest.main()
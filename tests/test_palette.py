@@ -0,0 +1,104 @@
+################################################################################
+# Copyright (c) 2021 Miroff
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+"""
+Palette tiles: tiles sharing a palette are matched by palette index, tiles
+with different palettes or mixed with RGB tiles by color.
+"""
+
+import io
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from lakkavokka.load import decodeTile, openImage, PaletteCheck, PaletteError
+from lakkavokka.contours import load_range, class_values, pack_rgb, tile_size
+
+GREEN, BLUE = (0, 100, 0), (0, 0, 255)
+
+"""
+Decoded palette tile: the left half has palette index 0, the right half
+index 1
+"""
+def palette_tile(colors):
+    image = Image.new('P', (tile_size, tile_size), 0)
+    image.putpalette([c for color in colors for c in color])
+    image.paste(1, (tile_size // 2, 0, tile_size, tile_size))
+    out = io.BytesIO()
+    image.save(out, 'PNG')
+    return decodeTile(openImage(out.getvalue()))
+
+def rgb_tile(color):
+    out = io.BytesIO()
+    Image.new('RGB', (tile_size, tile_size), color).save(out, 'PNG')
+    return decodeTile(openImage(out.getvalue()))
+
+def load(tiles):
+    return load_range(16, 0, 0, len(tiles) - 1, 0, lambda zoom, x, y: tiles[x])
+
+class PaletteTest(unittest.TestCase):
+    def test_shared_palette(self):
+        image = load([palette_tile([GREEN, BLUE]), palette_tile([GREEN, BLUE])])
+
+        self.assertEqual(image.ndim, 2)
+        self.assertEqual(image[0, 0], 0)
+        self.assertEqual(image[0, tile_size + tile_size // 2], 1)
+
+    def test_different_palettes(self):
+        # The same colors with swapped indices
+        image = load([palette_tile([GREEN, BLUE]), palette_tile([BLUE, GREEN])])
+        values = class_values(image)
+
+        green, blue = pack_rgb(np.array([[GREEN, BLUE]], dtype=np.uint8))[0]
+        self.assertEqual(values[0, 0], green)
+        self.assertEqual(values[0, tile_size // 2], blue)
+        self.assertEqual(values[0, tile_size], blue)
+        self.assertEqual(values[0, tile_size + tile_size // 2], green)
+
+    def test_palette_and_rgb(self):
+        green, blue = pack_rgb(np.array([[GREEN, BLUE]], dtype=np.uint8))[0]
+        values = class_values(load([palette_tile([GREEN, BLUE]), rgb_tile(BLUE)]))
+        self.assertTrue((values[:, :tile_size // 2] == green).all())
+        self.assertTrue((values[:, tile_size // 2:] == blue).all())
+
+        values = class_values(load([rgb_tile(BLUE), palette_tile([GREEN, BLUE])]))
+        self.assertTrue((values[:, :tile_size] == blue).all())
+        self.assertTrue((values[:, tile_size:tile_size + tile_size // 2] == green).all())
+
+    def test_missing_tile(self):
+        # Background index 1 is the color of the first palette
+        tiles = [palette_tile([GREEN, BLUE]), palette_tile([BLUE, GREEN]), None]
+        values = class_values(load_range(16, 0, 0, 2, 0, lambda zoom, x, y: tiles[x], background=1))
+        self.assertTrue((values[:, 2 * tile_size:] == values[0, tile_size // 2]).all())
+
+    def test_check(self):
+        check = PaletteCheck()
+        check(palette_tile([GREEN, BLUE]))
+        check(palette_tile([GREEN, BLUE]))
+        with self.assertRaises(PaletteError):
+            check(palette_tile([BLUE, GREEN]))
+        with self.assertRaises(PaletteError):
+            check(rgb_tile(GREEN))
+
+if __name__ == '__main__':
+    unittest.main()